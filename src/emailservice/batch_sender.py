@@ -0,0 +1,60 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent import futures
+
+# Sends (email address, content) messages through `send_batch`, which
+# delivers a list of at most `batch_size` messages in one provider call and
+# returns one error per message (None for sent messages) without raising,
+# so a failure never hides which messages went out. At most
+# `max_concurrency` batches are in flight at any time, across all callers.
+class BatchSender(object):
+  def __init__(self, send_batch, batch_size=50, max_concurrency=4):
+    self.send_batch = send_batch
+    self.batch_size = batch_size
+    self._executor = futures.ThreadPoolExecutor(
+      max_workers=max_concurrency, thread_name_prefix='email-sender')
+    self._pending = set()
+
+  def send(self, messages):
+    batches = [messages[i:i + self.batch_size]
+               for i in range(0, len(messages), self.batch_size)]
+    pending = [self._submit(batch) for batch in batches]
+    errors = []
+    for future in pending:
+      errors.extend(future.result())
+    return errors
+
+  async def send_async(self, messages):
+    # same as send() but awaits the batches instead of blocking on them
+    batches = [messages[i:i + self.batch_size]
+               for i in range(0, len(messages), self.batch_size)]
+    results = await asyncio.gather(*[
+      asyncio.wrap_future(self._submit(batch)) for batch in batches])
+    return [error for errors in results for error in errors]
+
+  def _submit(self, batch):
+    future = self._executor.submit(self.send_batch, batch)
+    self._pending.add(future)
+    future.add_done_callback(self._pending.discard)
+    return future
+
+  def shutdown(self, timeout=None):
+    # batches that have not started are dropped, the ones being sent get at
+    # most `timeout` seconds to finish
+    self._executor.shutdown(wait=False, cancel_futures=True)
+    futures.wait(list(self._pending), timeout)
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares a new channel per call (how send_confirmation_email used to work)
+# with the pooled EmailClient, against an in-process EmailService that
+# accepts every email:
+#
+#   python client_benchmark.py [calls]
+
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+import demo_pb2
+import demo_pb2_grpc
+from email_client import EmailClient
+
+class AcceptingEmailService(demo_pb2_grpc.EmailServiceServicer):
+  def SendOrderConfirmation(self, request, context):
+    return demo_pb2.Empty()
+
+  def SendOrderConfirmations(self, request, context):
+    return demo_pb2.SendOrderConfirmationsResponse(results=[
+      demo_pb2.SendOrderConfirmationResult(sent=True) for _ in request.requests])
+
+def startServer():
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+  demo_pb2_grpc.add_EmailServiceServicer_to_server(AcceptingEmailService(), server)
+  port = server.add_insecure_port('127.0.0.1:0')
+  server.start()
+  return server, '127.0.0.1:{}'.format(port)
+
+def perCallChannel(target, order, calls):
+  for _ in range(calls):
+    channel = grpc.insecure_channel(target)
+    demo_pb2_grpc.EmailServiceStub(channel).SendOrderConfirmation(
+      demo_pb2.SendOrderConfirmationRequest(email = 'someone@example.com', order = order))
+    channel.close()
+
+def pooled(client, order, calls):
+  for _ in range(calls):
+    client.send_confirmation('someone@example.com', order)
+
+def batched(client, order, calls, batch_size=50):
+  for i in range(0, calls, batch_size):
+    client.send_confirmations([('someone@example.com', order)] * min(batch_size, calls - i))
+
+def measure(name, fn, calls):
+  start = time.perf_counter()
+  fn()
+  elapsed = time.perf_counter() - start
+  print("{:<22} {:>8.0f} emails/s  {:>7.3f} ms/email".format(
+    name, calls / elapsed, elapsed / calls * 1000))
+
+if __name__ == '__main__':
+  calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  server, target = startServer()
+  order = demo_pb2.OrderResult(order_id='6f1d3c2e', items=[
+    demo_pb2.OrderItem(item=demo_pb2.CartItem(product_id='OLJCESPC7Z', quantity=1))])
+  client = EmailClient(target)
+  client.send_confirmation('someone@example.com', order)
+  measure("channel per call", lambda: perCallChannel(target, order, calls), calls)
+  measure("pooled client", lambda: pooled(client, order, calls), calls)
+  measure("pooled, batches of 50", lambda: batched(client, order, calls), calls)
+  client.close()
+  server.stop(0)
@@ -14,6 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import os
+import threading
+
 import grpc
 
 import demo_pb2
@@ -22,14 +26,92 @@ import demo_pb2_grpc
 from logger import getJSONLogger
 logger = getJSONLogger('emailservice-client')
 
+def channelOptions():
+  # keepalive pings detect dead connections while the channels sit idle
+  keepalive_ms = int(os.environ.get('EMAIL_CLIENT_KEEPALIVE_MS', "30000"))
+  options = [('grpc.use_local_subchannel_pool', 1)]
+  if keepalive_ms > 0:
+    options += [
+      ('grpc.keepalive_time_ms', keepalive_ms),
+      ('grpc.keepalive_timeout_ms', 10000),
+      ('grpc.keepalive_permit_without_calls', 1),
+      ('grpc.http2.max_pings_without_data', 0),
+    ]
+  return options
+
+# Client for EmailService holding `channels` long-lived channels, each on its
+# own connection, that calls are spread over round-robin. Every call has a
+# deadline of `deadline` seconds unless a timeout is given. Instances are
+# thread-safe and meant to be shared, see getClient().
+class EmailClient(object):
+  def __init__(self, target, channels=2, deadline=5.0, aio=False):
+    new_channel = grpc.aio.insecure_channel if aio else grpc.insecure_channel
+    self.deadline = deadline
+    self.channels = [new_channel(target, options=channelOptions())
+                     for _ in range(max(1, channels))]
+    self._stubs = [demo_pb2_grpc.EmailServiceStub(c) for c in self.channels]
+    self._next = itertools.count()
+
+  def stub(self):
+    return self._stubs[next(self._next) % len(self._stubs)]
+
+  def send_confirmation(self, email, order, timeout=None):
+    self.stub().SendOrderConfirmation(
+      demo_pb2.SendOrderConfirmationRequest(email = email, order = order),
+      timeout=timeout or self.deadline)
+
+  def send_confirmations(self, confirmations, timeout=None):
+    # confirmations is a list of (email, order), returns one
+    # SendOrderConfirmationResult per confirmation in the same order
+    response = self.stub().SendOrderConfirmations(
+      batchRequest(confirmations), timeout=timeout or self.deadline)
+    return list(response.results)
+
+  def close(self):
+    for channel in self.channels:
+      channel.close()
+
+class AsyncEmailClient(EmailClient):
+  def __init__(self, target, channels=2, deadline=5.0):
+    super().__init__(target, channels, deadline, aio=True)
+
+  async def send_confirmation(self, email, order, timeout=None):
+    await self.stub().SendOrderConfirmation(
+      demo_pb2.SendOrderConfirmationRequest(email = email, order = order),
+      timeout=timeout or self.deadline)
+
+  async def send_confirmations(self, confirmations, timeout=None):
+    response = await self.stub().SendOrderConfirmations(
+      batchRequest(confirmations), timeout=timeout or self.deadline)
+    return list(response.results)
+
+  async def close(self):
+    for channel in self.channels:
+      await channel.close()
+
+def batchRequest(confirmations):
+  return demo_pb2.SendOrderConfirmationsRequest(requests=[
+    demo_pb2.SendOrderConfirmationRequest(email = email, order = order)
+    for email, order in confirmations])
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def getClient(target=None):
+  # one EmailClient per target and process; EMAIL_SERVICE_ADDR is the default
+  # target, EMAIL_CLIENT_CHANNELS and EMAIL_CLIENT_DEADLINE configure it
+  target = target or os.environ.get('EMAIL_SERVICE_ADDR', '[::]:8080')
+  with _clients_lock:
+    if target not in _clients:
+      _clients[target] = EmailClient(
+        target,
+        channels=int(os.environ.get('EMAIL_CLIENT_CHANNELS', "2")),
+        deadline=float(os.environ.get('EMAIL_CLIENT_DEADLINE', "5")))
+    return _clients[target]
+
 def send_confirmation_email(email, order):
-  channel = grpc.insecure_channel('[::]:8080')
-  stub = demo_pb2_grpc.EmailServiceStub(channel)
   try:
-    response = stub.SendOrderConfirmation(demo_pb2.SendOrderConfirmationRequest(
-      email = email,
-      order = order
-    ))
+    getClient().send_confirmation(email, order)
     logger.info('Request sent.')
   except grpc.RpcError as err:
     logger.error(err.details())
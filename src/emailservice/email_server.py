@@ -16,13 +16,17 @@
 
 from concurrent import futures
 import argparse
+import asyncio
+import functools
 import os
+import signal
+import smtplib
 import sys
+import threading
 import time
 import grpc
 import traceback
-from jinja2 import Environment, FileSystemLoader, select_autoescape, TemplateError
-from google.api_core.exceptions import GoogleAPICallError
+from jinja2 import TemplateError
 from google.auth.exceptions import DefaultCredentialsError
 
 import demo_pb2
@@ -31,25 +35,114 @@ from grpc_health.v1 import health_pb2
 from grpc_health.v1 import health_pb2_grpc
 
 from opentelemetry import trace
-from opentelemetry.instrumentation.grpc import GrpcInstrumentorServer
+from opentelemetry.instrumentation.grpc import GrpcAioInstrumentorServer, GrpcInstrumentorServer
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 
 import googlecloudprofiler
 
+from batch_sender import BatchSender
+from concurrency_limit import AdaptiveLimiter, AsyncConcurrencyLimitInterceptor, ConcurrencyLimitInterceptor
+from email_templates import OrderView, loadTemplate
+from fake_smtp import FakeSmtpServer
+from idempotency import AsyncIdempotencyCache, IdempotencyCache
+from outbox import Outbox
+from smtp_transport import SEND_ERROR, SmtpTransport
+from tracing import newSampler, newSpanProcessor
 from logger import getJSONLogger
 logger = getJSONLogger('emailservice-server')
 
-# Loads confirmation email template from file
-env = Environment(
-    loader=FileSystemLoader('templates'),
-    autoescape=select_autoescape(['html', 'xml'])
-)
-template = env.get_template('confirmation.html')
+# Loads confirmation email template, precompiled at build time if available
+template = loadTemplate('confirmation.html')
+
+PREPARE_ERROR = "An error occurred when preparing the confirmation mail."
+
+def renderConfirmation(order):
+  return template.render(order = OrderView(order))
+
+def newBatchSender(transport):
+  # EMAIL_BATCH_SIZE is the number of messages handed to the provider in one
+  # call, EMAIL_BATCH_CONCURRENCY the number of provider calls in flight (by
+  # default as many as there are SMTP sessions batches may use)
+  return BatchSender(
+    transport.send_batch,
+    batch_size=int(os.environ.get('EMAIL_BATCH_SIZE', "50")),
+    max_concurrency=int(os.environ.get(
+      'EMAIL_BATCH_CONCURRENCY', str(transport.batch_pool_size))))
+
+def newOutbox(deliver):
+  # EMAIL_OUTBOX_PATH enables accept-then-deliver: confirmations are stored in
+  # a SQLite outbox at that path and sent by background workers. The
+  # deployment manifests run with readOnlyRootFilesystem and no volume, so
+  # the path has to be on a writable volume mounted into the pod, and on a
+  # persistent one for stored confirmations to outlive the pod
+  path = os.environ.get('EMAIL_OUTBOX_PATH', '')
+  if path == "":
+    return None
+  outbox = Outbox(
+    path, deliver,
+    workers=int(os.environ.get('EMAIL_OUTBOX_WORKERS', "4")),
+    max_attempts=int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', "8")))
+  outbox.start()
+  return outbox
+
+def newTransport(name):
+  # "smtp" sends through the SMTP server at SMTP_ADDR (host[:port], port 25 if
+  # not given), "fake-smtp" through an in-process FakeSmtpServer that
+  # acknowledges every message after FAKE_SMTP_LATENCY_MS, for load tests
+  # without a mail provider. SMTP_POOL_SIZE sessions are kept open, of which
+  # SMTP_RESERVED_SESSIONS are only used by single confirmations, and a
+  # message waits at most SMTP_ACQUIRE_TIMEOUT seconds for a free session
+  if name == "fake-smtp":
+    fake_server = FakeSmtpServer(
+      latency=float(os.environ.get('FAKE_SMTP_LATENCY_MS', "0")) / 1000).start()
+    logger.info("started fake SMTP server on port: " + str(fake_server.port))
+    host, port = '127.0.0.1', fake_server.port
+  elif name == "smtp":
+    smtp_addr = os.environ.get('SMTP_ADDR', '')
+    if smtp_addr == "":
+      raise Exception('SMTP_ADDR environment variable not set')
+    host, _, port = smtp_addr.rpartition(':')
+    if host == "":
+      host, port = port, "25"
+    if not port.isdigit():
+      raise Exception('SMTP_ADDR is not host[:port]: ' + smtp_addr)
+  else:
+    raise Exception('unknown EMAIL_TRANSPORT: ' + name)
+  return SmtpTransport(
+    host, int(port),
+    sender=os.environ.get('SMTP_SENDER', "no-reply@example.com"),
+    pool_size=int(os.environ.get('SMTP_POOL_SIZE', "4")),
+    acquire_timeout=float(os.environ.get('SMTP_ACQUIRE_TIMEOUT', "5")),
+    reserved=int(os.environ.get('SMTP_RESERVED_SESSIONS', "1")),
+    starttls=os.environ.get('SMTP_STARTTLS') == "1",
+    username=os.environ.get('SMTP_USERNAME'),
+    password=os.environ.get('SMTP_PASSWORD'))
+
+def newIdempotencyCache(cache_class=IdempotencyCache):
+  # EMAIL_IDEMPOTENCY_TTL is how long (in seconds) the outcome of a
+  # confirmation is remembered per order id and email address, 0 disables
+  ttl = float(os.environ.get('EMAIL_IDEMPOTENCY_TTL', "600"))
+  if ttl <= 0:
+    return None
+  return cache_class(
+    ttl, int(os.environ.get('EMAIL_IDEMPOTENCY_MAX_ENTRIES', "10000")))
+
+def confirmationResults(errors):
+  return demo_pb2.SendOrderConfirmationsResponse(results=[
+    demo_pb2.SendOrderConfirmationResult(sent=error is None, error=error or '')
+    for error in errors])
 
 class BaseEmailService(demo_pb2_grpc.EmailServiceServicer):
+  def __init__(self):
+    # cleared when the server starts draining so that health checks report
+    # NOT_SERVING while in-flight calls finish
+    self.serving = True
+
   def Check(self, request, context):
+    if not self.serving:
+      return health_pb2.HealthCheckResponse(
+        status=health_pb2.HealthCheckResponse.NOT_SERVING)
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.SERVING)
   
@@ -57,70 +150,259 @@ class BaseEmailService(demo_pb2_grpc.EmailServiceServicer):
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.UNIMPLEMENTED)
 
+  def close(self, timeout=None):
+    pass
+
 class EmailService(BaseEmailService):
-  def __init__(self):
-    raise Exception('cloud mail client not implemented')
+  def __init__(self, transport):
     super().__init__()
-
-  @staticmethod
-  def send_email(client, email_address, content):
-    response = client.send_message(
-      sender = client.sender_path(project_id, region, sender_id),
-      envelope_from_authority = '',
-      header_from_authority = '',
-      envelope_from_address = from_address,
-      simple_message = {
-        "from": {
-          "address_spec": from_address,
-        },
-        "to": [{
-          "address_spec": email_address
-        }],
-        "subject": "Your Confirmation Email",
-        "html_body": content
-      }
-    )
-    logger.info("Message sent: {}".format(response.rfc822_message_id))
+    self.transport = transport
+    self.sender = newBatchSender(transport)
+    self.outbox = newOutbox(transport.send)
+    self.confirmations = newIdempotencyCache()
 
   def SendOrderConfirmation(self, request, context):
-    email = request.email
-    order = request.order
+    confirm = functools.partial(
+      self.confirm, request.email, request.order, context.time_remaining())
+    if self.confirmations is not None and request.order.order_id:
+      # a retried call for an order that was already confirmed gets the
+      # earlier outcome instead of rendering and sending the email again
+      error = self.confirmations.run(
+        (request.order.order_id, request.email), confirm,
+        cacheable=lambda error: error != SEND_ERROR)
+    else:
+      error = confirm()
+    if error is not None:
+      context.set_details(error)
+      context.set_code(grpc.StatusCode.INTERNAL)
+    return demo_pb2.Empty()
 
+  def confirm(self, email, order, timeout=None):
     try:
-      confirmation = template.render(order = order)
+      confirmation = renderConfirmation(order)
     except TemplateError as err:
-      context.set_details("An error occurred when preparing the confirmation mail.")
       logger.error(err.message)
-      context.set_code(grpc.StatusCode.INTERNAL)
-      return demo_pb2.Empty()
+      return PREPARE_ERROR
+
+    if self.outbox is not None:
+      # the order is confirmed once the email is stored, it is sent later
+      self.outbox.enqueue(email, confirmation)
+      return None
 
     try:
-      EmailService.send_email(self.client, email, confirmation)
-    except GoogleAPICallError as err:
-      context.set_details("An error occurred when sending the email.")
-      print(err.message)
-      context.set_code(grpc.StatusCode.INTERNAL)
-      return demo_pb2.Empty()
+      self.transport.send(email, confirmation, timeout)
+    except (smtplib.SMTPException, OSError, ValueError) as err:
+      logger.error(str(err))
+      return SEND_ERROR
+    return None
+
+  def SendOrderConfirmations(self, request, context):
+    errors, messages, positions = self.prepare(request.requests)
+    if self.outbox is not None:
+      return confirmationResults(errors)
+    for i, error in zip(positions, self.sender.send(messages)):
+      errors[i] = error
+    return confirmationResults(errors)
+
+  def prepare(self, requests):
+    # renders the batched confirmations, returning the per-request errors,
+    # the (email, content) messages to send and their request positions;
+    # with the outbox the messages are stored instead and count as sent
+    errors = [None] * len(requests)
+    messages = []
+    positions = []
+    for i, confirmation_request in enumerate(requests):
+      try:
+        messages.append((confirmation_request.email,
+                         renderConfirmation(confirmation_request.order)))
+        positions.append(i)
+      except TemplateError as err:
+        logger.error(err.message)
+        errors[i] = PREPARE_ERROR
+    if self.outbox is not None:
+      for email, confirmation in messages:
+        self.outbox.enqueue(email, confirmation)
+    return errors, messages, positions
 
+  def close(self, timeout=None):
+    # the outbox, the SMTP sessions and the batch sender share `timeout`;
+    # stored confirmations that are not sent by then stay in the outbox and
+    # are delivered after the restart. Closing the transport stops batches
+    # between two messages, so the sender is shut down after it
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if self.outbox is not None:
+      self.outbox.stop(timeLeft(deadline))
+    self.transport.close(timeLeft(deadline))
+    self.sender.shutdown(timeLeft(deadline))
+
+# Servicer for the grpc.aio server. Rendering (and storing in the outbox)
+# runs in a bounded executor and sends are awaited, so calls waiting for the
+# mail server hold neither the event loop nor a thread each; at most as many
+# sends as there are pooled SMTP sessions run at the same time.
+class AsyncEmailService(EmailService):
+  def __init__(self, transport):
+    super().__init__(transport)
+    self.confirmations = newIdempotencyCache(AsyncIdempotencyCache)
+    # EMAIL_RENDER_WORKERS is the number of threads rendering confirmations
+    self.render_executor = futures.ThreadPoolExecutor(
+      max_workers=int(os.environ.get('EMAIL_RENDER_WORKERS', "4")),
+      thread_name_prefix='email-render')
+    self.send_executor = futures.ThreadPoolExecutor(
+      max_workers=transport.pool_size, thread_name_prefix='email-send')
+
+  async def SendOrderConfirmation(self, request, context):
+    confirm = functools.partial(
+      self.confirm_async, request.email, request.order, context.time_remaining())
+    if self.confirmations is not None and request.order.order_id:
+      error = await self.confirmations.run(
+        (request.order.order_id, request.email), confirm,
+        cacheable=lambda error: error != SEND_ERROR)
+    else:
+      error = await confirm()
+    if error is not None:
+      context.set_details(error)
+      context.set_code(grpc.StatusCode.INTERNAL)
     return demo_pb2.Empty()
 
+  async def confirm_async(self, email, order, timeout=None):
+    loop = asyncio.get_running_loop()
+    try:
+      confirmation = await loop.run_in_executor(self.render_executor, renderConfirmation, order)
+    except TemplateError as err:
+      logger.error(err.message)
+      return PREPARE_ERROR
+
+    if self.outbox is not None:
+      await loop.run_in_executor(self.render_executor, self.outbox.enqueue, email, confirmation)
+      return None
+
+    try:
+      await loop.run_in_executor(
+        self.send_executor, self.transport.send, email, confirmation, timeout)
+    except (smtplib.SMTPException, OSError, ValueError) as err:
+      logger.error(str(err))
+      return SEND_ERROR
+    return None
+
+  async def SendOrderConfirmations(self, request, context):
+    errors, messages, positions = await asyncio.get_running_loop().run_in_executor(
+      self.render_executor, self.prepare, request.requests)
+    if self.outbox is not None:
+      return confirmationResults(errors)
+    for i, error in zip(positions, await self.sender.send_async(messages)):
+      errors[i] = error
+    return confirmationResults(errors)
+
+  def close(self, timeout=None):
+    # sends still running in the executors are bounded by the SMTP timeout
+    self.render_executor.shutdown(wait=False, cancel_futures=True)
+    self.send_executor.shutdown(wait=False, cancel_futures=True)
+    super().close(timeout)
+
+  async def Check(self, request, context):
+    return super().Check(request, context)
+
+  async def Watch(self, request, context):
+    return super().Watch(request, context)
+
 class DummyEmailService(BaseEmailService):
   def SendOrderConfirmation(self, request, context):
     logger.info('A request to send order confirmation email to {} has been received.'.format(request.email))
     return demo_pb2.Empty()
 
+  def SendOrderConfirmations(self, request, context):
+    logger.info('A request to send {} order confirmation emails has been received.'.format(len(request.requests)))
+    return confirmationResults([None] * len(request.requests))
+
+class AsyncDummyEmailService(DummyEmailService):
+  async def SendOrderConfirmation(self, request, context):
+    return super().SendOrderConfirmation(request, context)
+
+  async def SendOrderConfirmations(self, request, context):
+    return super().SendOrderConfirmations(request, context)
+
+  async def Check(self, request, context):
+    return super().Check(request, context)
+
+  async def Watch(self, request, context):
+    return super().Watch(request, context)
+
 class HealthCheck():
   def Check(self, request, context):
     return health_pb2.HealthCheckResponse(
       status=health_pb2.HealthCheckResponse.SERVING)
 
-def start(dummy_mode):
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),)
-  service = None
-  if dummy_mode:
-    service = DummyEmailService()
-  else:
-    raise Exception('non-dummy mode not implemented yet')
+def newService(transport_name, server_mode):
+  if transport_name == "dummy":
+    return AsyncDummyEmailService() if server_mode == "aio" else DummyEmailService()
+  transport = newTransport(transport_name)
+  return AsyncEmailService(transport) if server_mode == "aio" else EmailService(transport)
+
+def newInterceptors(interceptor_class):
+  # CONCURRENCY_LIMIT_MAX=0 disables admission control; otherwise calls are
+  # admitted up to an adaptive limit that starts at CONCURRENCY_LIMIT_INITIAL
+  # and stays within CONCURRENCY_LIMIT_MIN and CONCURRENCY_LIMIT_MAX.
+  # Rejected calls are logged with the current limit.
+  max_limit = int(os.environ.get('CONCURRENCY_LIMIT_MAX', "200"))
+  if max_limit <= 0:
+    return []
+  return [interceptor_class(AdaptiveLimiter(
+    initial_limit=int(os.environ.get('CONCURRENCY_LIMIT_INITIAL', "20")),
+    min_limit=int(os.environ.get('CONCURRENCY_LIMIT_MIN', "2")),
+    max_limit=max_limit,
+    tolerance=float(os.environ.get('CONCURRENCY_LIMIT_TOLERANCE', "2"))))]
+
+def serverOptions():
+  # EmailClient keeps its pooled channels warm with keepalive pings while
+  # they are idle (EMAIL_CLIENT_KEEPALIVE_MS, 30s by default). gRPC servers
+  # reject pings without calls and more often than every 5 minutes by
+  # default, answering with GOAWAY "too_many_pings" and dropping the
+  # connection, so both are allowed here.
+  return [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', 10000),
+  ]
+
+def shutdownTimeouts():
+  # SHUTDOWN_DELAY is how long (in seconds) health checks report NOT_SERVING
+  # before the server stops accepting calls, to give load balancers time to
+  # take the instance out of rotation; SHUTDOWN_GRACE_PERIOD is how long
+  # in-flight calls, closing the service and flushing traces then get
+  # together. Both count towards the pod's terminationGracePeriodSeconds (5s
+  # in the manifests), raise it along with them
+  return (float(os.environ.get('SHUTDOWN_DELAY', "0")),
+          float(os.environ.get('SHUTDOWN_GRACE_PERIOD', "4")))
+
+def beginDrain(service):
+  # returns the delay and the deadline by which every step of the drain has
+  # to be done, each step only gets the time that is left
+  delay, grace = shutdownTimeouts()
+  logger.info("draining: stopping in {}s, done within {}s".format(delay, delay + grace))
+  service.serving = False
+  return delay, time.monotonic() + delay + grace
+
+def timeLeft(deadline):
+  # seconds left until `deadline` (a time.monotonic() value), None for none
+  if deadline is None:
+    return None
+  return max(0.0, deadline - time.monotonic())
+
+def flushTraces(timeout):
+  # exports the spans still buffered by the batch span processor, giving up
+  # after `timeout` seconds if the collector is unreachable
+  provider = trace.get_tracer_provider()
+  if isinstance(provider, TracerProvider):
+    provider.force_flush(int(timeout * 1000))
+
+def start(transport_name, server_mode):
+  if server_mode == "aio":
+    asyncio.run(serve_aio(transport_name))
+    return
+
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                       interceptors=newInterceptors(ConcurrencyLimitInterceptor),
+                       options=serverOptions())
+  service = newService(transport_name, server_mode)
 
   demo_pb2_grpc.add_EmailServiceServicer_to_server(service, server)
   health_pb2_grpc.add_HealthServicer_to_server(service, server)
@@ -129,11 +411,50 @@ def start(dummy_mode):
   logger.info("listening on port: "+port)
   server.add_insecure_port('[::]:'+port)
   server.start()
-  try:
-    while True:
-      time.sleep(3600)
-  except KeyboardInterrupt:
-    server.stop(0)
+
+  # SIGTERM (rolling restarts) and SIGINT both drain the server
+  stopping = threading.Event()
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, lambda signum, frame: stopping.set())
+  stopping.wait()
+
+  delay, deadline = beginDrain(service)
+  time.sleep(delay)
+  server.stop(timeLeft(deadline)).wait()
+  service.close(timeLeft(deadline))
+  flushTraces(timeLeft(deadline))
+
+async def serve_aio(transport_name):
+  # a single event loop serves all calls, no per-request worker threads
+  server = grpc.aio.server(
+    interceptors=newInterceptors(AsyncConcurrencyLimitInterceptor),
+    options=serverOptions())
+  service = newService(transport_name, "aio")
+
+  demo_pb2_grpc.add_EmailServiceServicer_to_server(service, server)
+  health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+  port = os.environ.get('PORT', "8080")
+  logger.info("listening on port: "+port+" (asyncio)")
+  server.add_insecure_port('[::]:'+port)
+  await server.start()
+
+  stopping = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    loop.add_signal_handler(signum, stopping.set)
+  await stopping.wait()
+
+  delay, deadline = beginDrain(service)
+  await asyncio.sleep(delay)
+  await server.stop(timeLeft(deadline))
+  await loop.run_in_executor(None, service.close, timeLeft(deadline))
+  flushTraces(timeLeft(deadline))
+
+# Bounded exponential backoff for starting the profiler agent.
+PROFILER_MAX_ATTEMPTS = 5
+PROFILER_INITIAL_DELAY = 1
+PROFILER_MAX_DELAY = 30
 
 def initStackdriverProfiling():
   project_id = None
@@ -143,26 +464,42 @@ def initStackdriverProfiling():
     # Environment variable not set
     pass
 
-  for retry in range(1,4):
+  # Called on a background thread (see startStackdriverProfiling), from which
+  # the agent cannot set up wall time profiling, hence CPU profiling only.
+  delay = PROFILER_INITIAL_DELAY
+  for attempt in range(1, PROFILER_MAX_ATTEMPTS + 1):
     try:
       if project_id:
-        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, project_id=project_id)
+        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, project_id=project_id, disable_wall_profiling=True)
       else:
-        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0)
+        googlecloudprofiler.start(service='email_server', service_version='1.0.0', verbose=0, disable_wall_profiling=True)
       logger.info("Successfully started Stackdriver Profiler.")
       return
     except (BaseException) as exc:
       logger.info("Unable to start Stackdriver Profiler Python agent. " + str(exc))
-      if (retry < 4):
-        logger.info("Sleeping %d to retry initializing Stackdriver Profiler"%(retry*10))
-        time.sleep (1)
+      if (attempt < PROFILER_MAX_ATTEMPTS):
+        logger.info("Sleeping %d to retry initializing Stackdriver Profiler"%(delay))
+        time.sleep(delay)
+        delay = min(delay * 2, PROFILER_MAX_DELAY)
       else:
         logger.warning("Could not initialize Stackdriver Profiler after retrying, giving up")
   return
 
+def startStackdriverProfiling():
+  # the agent is started in the background so that an unreachable profiler
+  # backend does not hold up serving
+  threading.Thread(target=initStackdriverProfiling, name='profiler-init', daemon=True).start()
+
 
 if __name__ == '__main__':
-  logger.info('starting the email service in dummy mode.')
+  # EMAIL_TRANSPORT is "dummy" (emails are only logged), "smtp" or "fake-smtp"
+  transport_name = os.environ.get('EMAIL_TRANSPORT', "dummy")
+  # "aio" selects the asyncio server, anything else the thread pool server
+  server_mode = os.environ.get('SERVER_MODE', "sync")
+  if transport_name == "dummy":
+    logger.info('starting the email service in dummy mode.')
+  else:
+    logger.info('starting the email service with the {} transport.'.format(transport_name))
 
   # Profiler
   try:
@@ -170,7 +507,7 @@ if __name__ == '__main__':
       raise KeyError()
     else:
       logger.info("Profiler enabled.")
-      initStackdriverProfiling()
+      startStackdriverProfiling()
   except KeyError:
       logger.info("Profiler disabled.")
 
@@ -178,21 +515,27 @@ if __name__ == '__main__':
   try:
     if os.environ["ENABLE_TRACING"] == "1":
       otel_endpoint = os.getenv("COLLECTOR_SERVICE_ADDR", "localhost:4317")
-      trace.set_tracer_provider(TracerProvider())
+      # spans are flushed (with a deadline) when the server drains, instead of
+      # by the SDK's exit hook that retries an unreachable collector for ~1min
+      trace.set_tracer_provider(TracerProvider(
+        sampler=newSampler(), shutdown_on_exit=False))
       trace.get_tracer_provider().add_span_processor(
-        BatchSpanProcessor(
+        newSpanProcessor(
             OTLPSpanExporter(
             endpoint = otel_endpoint,
             insecure = True
           )
         )
       )
-    grpc_server_instrumentor = GrpcInstrumentorServer()
-    grpc_server_instrumentor.instrument()
+    if server_mode == "aio":
+      GrpcAioInstrumentorServer().instrument()
+    else:
+      grpc_server_instrumentor = GrpcInstrumentorServer()
+      grpc_server_instrumentor.instrument()
 
   except (KeyError, DefaultCredentialsError):
       logger.info("Tracing disabled.")
   except Exception as e:
       logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
   
-  start(dummy_mode = True)
+  start(transport_name, server_mode)
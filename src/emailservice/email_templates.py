@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Email templates are compiled to Python modules when the image is built:
+#
+#   python email_templates.py
+#
+# writes them to compiled_templates/, which is then preferred over parsing
+# templates/ at startup.
+
+import os
+import shutil
+
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, select_autoescape
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-templates')
+
+TEMPLATES_DIR = 'templates'
+COMPILED_TEMPLATES_DIR = 'compiled_templates'
+
+def newEnvironment(loader):
+  return Environment(
+    loader=loader,
+    autoescape=select_autoescape(['html', 'xml'])
+  )
+
+def compileTemplates(target=COMPILED_TEMPLATES_DIR):
+  shutil.rmtree(target, ignore_errors=True)
+  newEnvironment(FileSystemLoader(TEMPLATES_DIR)).compile_templates(
+    target, zip=None, ignore_errors=False)
+
+def loadTemplate(name):
+  if os.path.isdir(COMPILED_TEMPLATES_DIR):
+    logger.info("Loading precompiled template {}".format(name))
+    return newEnvironment(ModuleLoader(COMPILED_TEMPLATES_DIR)).get_template(name)
+  logger.info("Compiling template {} from {}".format(name, TEMPLATES_DIR))
+  return newEnvironment(FileSystemLoader(TEMPLATES_DIR)).get_template(name)
+
+def formatMoney(money, separator='.'):
+  return '{}{}{:02d} {}'.format(
+    money.units, separator, money.nanos // 10000000, money.currency_code)
+
+# Plain view of an order for the confirmation template. All values are read
+# from the protobuf message and formatted once, so rendering only looks up
+# attributes of ordinary Python objects and unpacks item tuples.
+class OrderView(object):
+  __slots__ = ('order_id', 'shipping_tracking_id', 'shipping_cost',
+               'shipping_address', 'items')
+
+  def __init__(self, order):
+    address = order.shipping_address
+    self.order_id = order.order_id
+    self.shipping_tracking_id = order.shipping_tracking_id
+    self.shipping_cost = formatMoney(order.shipping_cost, separator='. ')
+    self.shipping_address = '{}, {}, {}, {} {}'.format(
+      address.street_address, address.city, address.state, address.country,
+      address.zip_code)
+    # (product id, quantity, price)
+    self.items = [(item.item.product_id, item.item.quantity, formatMoney(item.cost))
+                  for item in order.items]
+
+if __name__ == '__main__':
+  compileTemplates()
+  logger.info("Compiled templates from {} to {}".format(TEMPLATES_DIR, COMPILED_TEMPLATES_DIR))
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import socketserver
+import threading
+import time
+
+# Minimal in-process SMTP server standing in for a mail provider in tests
+# and load tests. It accepts every message, optionally waiting `latency`
+# seconds before acknowledging each one, counts them, and keeps the last
+# `keep` messages as (sender, recipients, data) tuples.
+
+class _FakeSmtpHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    self._reply('220 fake-smtp ready')
+    sender = None
+    recipients = []
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      command = line.decode('utf-8', 'replace').rstrip('\r\n')
+      verb = command.split(' ', 1)[0].upper()
+      if verb == 'EHLO':
+        self._reply('250-fake-smtp\r\n250-8BITMIME\r\n250 SMTPUTF8')
+      elif verb == 'HELO':
+        self._reply('250 fake-smtp')
+      elif verb == 'MAIL':
+        sender = command[10:]
+        recipients = []
+        self._reply('250 OK')
+      elif verb == 'RCPT':
+        recipients.append(command[8:])
+        self._reply('250 OK')
+      elif verb == 'DATA':
+        self._reply('354 End data with <CR><LF>.<CR><LF>')
+        self.server.record(sender, recipients, self._read_data())
+        self._reply('250 OK')
+      elif verb in ('RSET', 'NOOP'):
+        self._reply('250 OK')
+      elif verb == 'QUIT':
+        self._reply('221 Bye')
+        return
+      else:
+        self._reply('502 Command not implemented')
+
+  def _read_data(self):
+    lines = []
+    while True:
+      line = self.rfile.readline()
+      if not line or line == b'.\r\n':
+        return b''.join(lines)
+      lines.append(line[1:] if line.startswith(b'.') else line)
+
+  def _reply(self, text):
+    self.wfile.write(text.encode('ascii') + b'\r\n')
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address=('127.0.0.1', 0), latency=0.0, keep=100):
+    socketserver.ThreadingTCPServer.__init__(self, address, _FakeSmtpHandler)
+    self.latency = latency
+    self.received = 0
+    self.messages = collections.deque(maxlen=keep)
+    self._lock = threading.Lock()
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def record(self, sender, recipients, data):
+    if self.latency > 0:
+      time.sleep(self.latency)
+    with self._lock:
+      self.received += 1
+      self.messages.append((sender, recipients, data))
+
+  def start(self):
+    threading.Thread(target=self.serve_forever, name='fake-smtp', daemon=True).start()
+    return self
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import threading
+import time
+
+class _Entry(object):
+  __slots__ = ('done', 'outcome', 'shared', 'expires_at')
+
+  def __init__(self, done):
+    self.done = done
+    self.outcome = None
+    self.shared = False
+    self.expires_at = None
+
+# Remembers the outcome of calls by key for `ttl` seconds, keeping at most
+# `max_entries` keys (the oldest are dropped first). run(key, fn) calls fn()
+# only if no call with the same key completed within the TTL; a duplicate
+# gets the earlier outcome back, and a duplicate arriving while the first
+# call still runs waits for it. Outcomes for which `cacheable(outcome)` is
+# false, and exceptions, are not remembered, so retries run again.
+class IdempotencyCache(object):
+  def __init__(self, ttl=600, max_entries=10000):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def run(self, key, fn, cacheable=lambda outcome: True):
+    while True:
+      entry, owner = self._claim(key, threading.Event)
+      if owner:
+        break
+      entry.done.wait()
+      if self._shared(entry):
+        return entry.outcome
+      # the call we waited for was not remembered, run it again
+
+    try:
+      outcome = fn()
+    except BaseException:
+      self._finish(key, entry, None, False)
+      raise
+    self._finish(key, entry, outcome, cacheable(outcome))
+    return outcome
+
+  def stats(self):
+    with self._lock:
+      return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+  def _claim(self, key, new_event):
+    # returns the entry for `key` and whether the caller has to run the call
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry.expires_at is not None and entry.expires_at < time.monotonic():
+        del self._entries[key]
+        entry = None
+      if entry is not None:
+        return entry, False
+      entry = self._entries[key] = _Entry(new_event())
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+      self.misses += 1
+      return entry, True
+
+  def _shared(self, entry):
+    with self._lock:
+      if entry.shared:
+        self.hits += 1
+      return entry.shared
+
+  def _finish(self, key, entry, outcome, shared):
+    with self._lock:
+      entry.outcome = outcome
+      entry.shared = shared
+      if shared:
+        entry.expires_at = time.monotonic() + self.ttl
+      elif self._entries.get(key) is entry:
+        del self._entries[key]
+    entry.done.set()
+
+# Variant of IdempotencyCache for the grpc.aio server: `fn` is a coroutine
+# function and duplicates wait on the event loop.
+class AsyncIdempotencyCache(IdempotencyCache):
+  async def run(self, key, fn, cacheable=lambda outcome: True):
+    while True:
+      entry, owner = self._claim(key, asyncio.Event)
+      if owner:
+        break
+      await entry.done.wait()
+      if self._shared(entry):
+        return entry.outcome
+
+    try:
+      outcome = await fn()
+    except BaseException:
+      self._finish(key, entry, None, False)
+      raise
+    self._finish(key, entry, outcome, cacheable(outcome))
+    return outcome
@@ -14,10 +14,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+import time
+from json.encoder import encode_basestring_ascii
 from pythonjsonlogger import jsonlogger
 
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 # TODO(yoshifumi) this class is duplicated since other Python services are
 # not sharing the modules for logging.
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
@@ -30,12 +43,135 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
     else:
       log_record['severity'] = record.levelname
 
+# attributes every LogRecord has; anything else was passed through `extra` or
+# set by a filter and is added to the output
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message', 'asctime', 'taskName'}
+
+def _dumps(value):
+  if orjson is not None:
+    return orjson.dumps(value, default=str).decode('utf-8')
+  return json.dumps(value, default=str)
+
+# Writes the same fields as CustomJsonFormatter (timestamp, severity, name,
+# message, extras and exc_info) without going through python-json-logger's
+# generic field handling: the part of the line that only depends on the logger
+# name and level is built once and cached, and the message is escaped with the
+# C string encoder from the json module.
+class FastJsonFormatter(logging.Formatter):
+  def __init__(self):
+    super(FastJsonFormatter, self).__init__()
+    self._prefixes = {}
+
+  def format(self, record):
+    prefix = self._prefixes.get((record.name, record.levelno))
+    if prefix is None:
+      prefix = ', "severity": {}, "name": {}, "message": '.format(
+          encode_basestring_ascii(record.levelname.upper()),
+          encode_basestring_ascii(record.name))
+      self._prefixes[(record.name, record.levelno)] = prefix
+    parts = ['{"timestamp": ', repr(record.created), prefix,
+             encode_basestring_ascii(record.getMessage())]
+    extras = record.__dict__.keys() - _RECORD_ATTRS
+    if extras:
+      for key in sorted(extras):
+        parts.append(', {}: {}'.format(encode_basestring_ascii(key), _dumps(record.__dict__[key])))
+    if record.exc_info:
+      if not record.exc_text:
+        record.exc_text = self.formatException(record.exc_info)
+    if record.exc_text:
+      parts.append(', "exc_info": ' + encode_basestring_ascii(record.exc_text))
+    parts.append('}')
+    return ''.join(parts)
+
+# Lets through at most `rate` INFO/DEBUG records per second from each call
+# site; warnings and errors always pass. The next record that gets through
+# carries the number of records dropped since in its `suppressed` field.
+class RateSamplingFilter(logging.Filter):
+  def __init__(self, rate):
+    super(RateSamplingFilter, self).__init__()
+    self.rate = rate
+    self._sites = {}
+    self._lock = threading.Lock()
+
+  def filter(self, record):
+    if record.levelno >= logging.WARNING:
+      return True
+    now = time.monotonic()
+    site = (record.pathname, record.lineno)
+    with self._lock:
+      tokens, last, suppressed = self._sites.get(site, (self.rate, now, 0))
+      tokens = min(self.rate, tokens + (now - last) * self.rate)
+      if tokens < 1:
+        self._sites[site] = (tokens, now, suppressed + 1)
+        return False
+      self._sites[site] = (tokens - 1, now, 0)
+    if suppressed:
+      record.suppressed = suppressed
+    return True
+
+# Hands records to the listener thread without ever blocking the caller.
+# The message and the traceback are resolved on the calling thread, so that
+# later changes to the arguments cannot alter the line and the traceback's
+# frames are not kept alive in the queue; the JSON line itself is built by
+# the listener. Records are dropped when the queue is full, and the next
+# record that gets through carries their number in its `suppressed` field.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+  def __init__(self, queue):
+    super(NonBlockingQueueHandler, self).__init__(queue)
+    self._dropped = 0
+
+  def prepare(self, record):
+    record.msg = record.getMessage()
+    record.args = None
+    if record.exc_info:
+      record.exc_text = _exceptionFormatter.formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def enqueue(self, record):
+    # called with the handler's lock held
+    if self._dropped:
+      record.suppressed = getattr(record, 'suppressed', 0) + self._dropped
+    try:
+      self.queue.put_nowait(record)
+      self._dropped = 0
+    except queue.Full:
+      self._dropped = getattr(record, 'suppressed', 0) + 1
+
+_exceptionFormatter = logging.Formatter()
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def _getQueueHandler():
+  # all loggers of the process share one queue, drained by a single thread
+  # that formats the records and writes them to stdout
+  global _listener
+  with _listener_lock:
+    if _listener is None:
+      log_queue = queue.Queue(int(os.environ.get('LOG_QUEUE_SIZE', "10000")))
+      handler = logging.StreamHandler(sys.stdout)
+      handler.setFormatter(FastJsonFormatter())
+      _listener = logging.handlers.QueueListener(log_queue, handler)
+      _listener.start()
+      atexit.register(_listener.stop)
+    return NonBlockingQueueHandler(_listener.queue)
+
 def getJSONLogger(name):
   logger = logging.getLogger(name)
-  handler = logging.StreamHandler(sys.stdout)
-  formatter = CustomJsonFormatter('%(timestamp)s %(severity)s %(name)s %(message)s')
-  handler.setFormatter(formatter)
+  # LOG_ASYNC=0 writes records synchronously from the calling thread
+  if os.environ.get('LOG_ASYNC', "1") == "0":
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(FastJsonFormatter())
+  else:
+    handler = _getQueueHandler()
   logger.addHandler(handler)
+  # LOG_RATE_LIMIT is the number of INFO records per second allowed from each
+  # call site, 0 disables sampling
+  rate = float(os.environ.get('LOG_RATE_LIMIT', "10"))
+  if rate > 0:
+    logger.addFilter(RateSamplingFilter(rate))
   logger.setLevel(logging.INFO)
   logger.propagate = False
   return logger
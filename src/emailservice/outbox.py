@@ -0,0 +1,145 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import sqlite3
+import threading
+import time
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-outbox')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  email TEXT NOT NULL,
+  content TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at REAL NOT NULL,
+  failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (failed, next_attempt_at);
+"""
+
+# Durable queue of rendered emails, kept in a SQLite database at `path`.
+# enqueue() returns once the message is committed; `workers` threads then
+# hand due messages to `deliver(email, content)`, which raises on failure.
+# Failed deliveries are retried with exponential backoff and jitter, from
+# `initial_backoff` up to `max_backoff` seconds, and given up (kept with the
+# failed flag set) after `max_attempts`. A message being delivered is leased
+# for `lease` seconds, so messages held by a crashed process are picked up
+# again after a restart: delivery is at least once.
+class Outbox(object):
+  def __init__(self, path, deliver, workers=4, max_attempts=8,
+               initial_backoff=1.0, max_backoff=300.0, lease=60.0):
+    self.deliver = deliver
+    self.workers = workers
+    self.max_attempts = max_attempts
+    self.initial_backoff = initial_backoff
+    self.max_backoff = max_backoff
+    self.lease = lease
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    # NORMAL would not sync the WAL on commit, and an OS or node crash could
+    # lose confirmations that enqueue() already reported as stored
+    self._db.execute('PRAGMA synchronous=FULL')
+    self._db.executescript(_SCHEMA)
+    self._lock = threading.Lock()
+    self._wakeup = threading.Condition(self._lock)
+    self._stopped = False
+    self._threads = []
+
+  def enqueue(self, email, content):
+    with self._lock:
+      self._db.execute(
+        'INSERT INTO outbox (email, content, next_attempt_at) VALUES (?, ?, ?)',
+        (email, content, time.time()))
+      self._wakeup.notify()
+
+  def pending(self):
+    with self._lock:
+      return self._db.execute('SELECT COUNT(*) FROM outbox WHERE failed = 0').fetchone()[0]
+
+  def start(self):
+    for i in range(self.workers):
+      thread = threading.Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+      thread.start()
+      self._threads.append(thread)
+    logger.info("Outbox started with {} workers, {} messages pending".format(
+      self.workers, self.pending()))
+
+  def stop(self, timeout=None):
+    # waits at most `timeout` seconds in total for the workers to finish the
+    # deliveries they are making
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._lock:
+      self._stopped = True
+      self._wakeup.notify_all()
+    for thread in self._threads:
+      thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+  def _run(self):
+    while True:
+      with self._lock:
+        message = self._claim()
+        while message is None:
+          if self._stopped:
+            return
+          self._wakeup.wait(self._next_due())
+          message = self._claim()
+      self._attempt(*message)
+
+  def _claim(self):
+    # takes the oldest due message and leases it; called with the lock held
+    now = time.time()
+    row = self._db.execute(
+      'SELECT id, email, content, attempts FROM outbox '
+      'WHERE failed = 0 AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1',
+      (now,)).fetchone()
+    if row is not None:
+      self._db.execute('UPDATE outbox SET next_attempt_at = ? WHERE id = ?',
+                       (now + self.lease, row[0]))
+    return row
+
+  def _next_due(self):
+    # seconds until the next message is due, called with the lock held
+    row = self._db.execute(
+      'SELECT MIN(next_attempt_at) FROM outbox WHERE failed = 0').fetchone()
+    if row[0] is None:
+      return None
+    return max(0.0, row[0] - time.time())
+
+  def _attempt(self, message_id, email, content, attempts):
+    try:
+      self.deliver(email, content)
+    except Exception as err:
+      attempts += 1
+      with self._lock:
+        if attempts >= self.max_attempts:
+          self._db.execute('UPDATE outbox SET attempts = ?, failed = 1 WHERE id = ?',
+                           (attempts, message_id))
+          logger.error("Giving up on email to {} after {} attempts: {}".format(
+            email, attempts, err))
+          return
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        self._db.execute('UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?',
+                         (attempts, time.time() + delay, message_id))
+      logger.warning("Sending email to {} failed (attempt {}), retrying in {:.1f}s: {}".format(
+        email, attempts, delay, err))
+      return
+    with self._lock:
+      self._db.execute('DELETE FROM outbox WHERE id = ?', (message_id,))
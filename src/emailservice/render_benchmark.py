@@ -0,0 +1,56 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures confirmation email renders per second (building the order view
+# included) for orders of increasing size:
+#
+#   python render_benchmark.py [items...]
+
+import sys
+import time
+
+import demo_pb2
+from email_templates import OrderView, loadTemplate
+
+def make_order(items):
+  order = demo_pb2.OrderResult(
+    order_id='6f1d3c2e-5d4a-4b8e-9f0a-1c2b3d4e5f60',
+    shipping_tracking_id='TK-123456789',
+    shipping_cost=demo_pb2.Money(currency_code='USD', units=8, nanos=990000000),
+    shipping_address=demo_pb2.Address(
+      street_address='1600 Amphitheatre Parkway', city='Mountain View',
+      state='CA', country='United States', zip_code=94043))
+  for i in range(items):
+    order.items.add(
+      item=demo_pb2.CartItem(product_id='OLJCESPC7Z-{}'.format(i), quantity=i % 5 + 1),
+      cost=demo_pb2.Money(currency_code='USD', units=19, nanos=990000000))
+  return order
+
+def run(template, order, seconds=1.0):
+  renders = 0
+  start = time.perf_counter()
+  while time.perf_counter() - start < seconds:
+    template.render(order=OrderView(order))
+    renders += 1
+  return renders / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+  sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000]
+  start = time.perf_counter()
+  template = loadTemplate('confirmation.html')
+  print("template loaded in {:.1f}ms".format((time.perf_counter() - start) * 1000))
+  for items in sizes:
+    print("{:>6} items: {:.0f} renders/s".format(items, run(template, make_order(items))))
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import smtplib
+import socket
+import threading
+import time
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+
+from logger import getJSONLogger
+logger = getJSONLogger('emailservice-smtp')
+
+SUBJECT = "Your Confirmation Email"
+SEND_ERROR = "An error occurred when sending the email."
+
+# A transport delivers rendered confirmation emails:
+#
+#   transport.send(email, content)       raises on failure
+#   transport.send_batch(messages)       list of (email, content) messages,
+#                                        returns one error (None if sent)
+#                                        per message and never raises
+#
+# SmtpTransport keeps up to `pool_size` SMTP sessions open and reuses them
+# across messages, so a message costs one MAIL/RCPT/DATA exchange instead of
+# a new TCP (and TLS) connection and login. A batch is sent over a single
+# session, and batches never hold more than `pool_size - reserved` sessions
+# so that bulk sends cannot hold up single confirmations. A message waits at
+# most `acquire_timeout` seconds for a free session. A session that was
+# closed by the server while idle is reopened once before the message is
+# reported as failed.
+class SmtpTransport(object):
+  def __init__(self, host, port, sender, pool_size=4, timeout=10,
+               acquire_timeout=5, reserved=1, starttls=False,
+               username=None, password=None):
+    self.host = host
+    self.port = port
+    self.sender = sender
+    # Message-IDs use the sender's domain, make_msgid() would otherwise look
+    # up the host name for every message
+    self._msgid_domain = sender.rpartition('@')[2] or None
+    self.timeout = timeout
+    self.starttls = starttls
+    self.username = username
+    self.password = password
+    self.pool_size = pool_size
+    self.acquire_timeout = acquire_timeout
+    self.batch_pool_size = max(1, pool_size - reserved)
+    self._idle = queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(pool_size)
+    self._batch_slots = threading.BoundedSemaphore(self.batch_pool_size)
+    # sessions handed out, so that close() can cut them off
+    self._busy = set()
+    self._lock = threading.Lock()
+    self._closed = False
+
+  def send(self, email, content, timeout=None):
+    # `timeout` further bounds the wait for a session, e.g. to the caller's
+    # deadline
+    message = self._message(email, content)
+    connection = self._acquire(timeout)
+    try:
+      connection = self._send(connection, message)
+    except Exception:
+      self._release(connection, broken=True)
+      raise
+    self._release(connection)
+
+  def send_batch(self, messages):
+    if not self._batch_slots.acquire(timeout=self.acquire_timeout):
+      logger.error("No SMTP session free for a batch within {}s".format(self.acquire_timeout))
+      return [SEND_ERROR] * len(messages)
+    try:
+      return self._send_batch(messages)
+    finally:
+      self._batch_slots.release()
+
+  def _send_batch(self, messages):
+    try:
+      connection = self._acquire()
+    except Exception as err:
+      logger.error("SMTP session failed: {}".format(err))
+      return [SEND_ERROR] * len(messages)
+    errors = []
+    broken = False
+    try:
+      for email, content in messages:
+        if broken or self._closed:
+          errors.append(SEND_ERROR)
+          continue
+        try:
+          connection = self._send(connection, self._message(email, content))
+          errors.append(None)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused, ValueError) as err:
+          # rejected by the server, or an address that cannot be put in the
+          # headers; the session itself is still usable
+          logger.error("Sending email to {} failed: {}".format(email, err))
+          errors.append(SEND_ERROR)
+        except Exception as err:
+          logger.error("SMTP session failed: {}".format(err))
+          broken = True
+          errors.append(SEND_ERROR)
+    finally:
+      # a session left in the middle of a message is not reused
+      self._release(connection, broken=broken or len(errors) < len(messages))
+    return errors
+
+  def close(self, timeout=None):
+    # stops taking messages (batches being sent fail their remaining
+    # messages) and gives the sessions in use up to `timeout` seconds to
+    # finish the message they are sending; sessions still in use then are cut
+    # off and idle sessions are ended with QUIT in the time that is left
+    deadline = None if timeout is None else time.monotonic() + timeout
+    self._closed = True
+    for _ in range(self.pool_size):
+      left = None if deadline is None else max(0.0, deadline - time.monotonic())
+      if not self._slots.acquire(timeout=left):
+        break
+    with self._lock:
+      busy = list(self._busy)
+    for connection in busy:
+      if connection.sock is not None:
+        try:
+          connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+    while True:
+      try:
+        connection = self._idle.get_nowait()
+      except queue.Empty:
+        return
+      if deadline is None:
+        self._close(connection)
+        continue
+      left = deadline - time.monotonic()
+      if left <= 0 or connection.sock is None:
+        connection.close()
+        continue
+      connection.sock.settimeout(min(left, self.timeout))
+      self._close(connection)
+
+  def _send(self, connection, message):
+    # returns the session to keep using, which is a new one if the server
+    # had closed `connection`
+    try:
+      connection.send_message(message)
+      return connection
+    except smtplib.SMTPServerDisconnected:
+      self._close(connection)
+      self._untrack(connection)
+    connection = self._connect()
+    self._track(connection)
+    try:
+      connection.send_message(message)
+    except Exception:
+      # the caller only knows the old (closed) session, which is reopened
+      # the next time it is used
+      self._close(connection)
+      self._untrack(connection)
+      raise
+    return connection
+
+  def _message(self, email, content):
+    message = EmailMessage()
+    message['From'] = self.sender
+    message['To'] = email
+    message['Subject'] = SUBJECT
+    message['Date'] = formatdate(localtime=True)
+    message['Message-ID'] = make_msgid(domain=self._msgid_domain)
+    message.set_content(content, subtype='html')
+    return message
+
+  def _acquire(self, timeout=None):
+    if self._closed:
+      raise smtplib.SMTPServerDisconnected('SMTP transport closed')
+    if timeout is None or timeout > self.acquire_timeout:
+      timeout = self.acquire_timeout
+    if not self._slots.acquire(timeout=max(0.0, timeout)):
+      raise TimeoutError('no SMTP session free within {:.1f}s'.format(timeout))
+    try:
+      connection = self._idle.get_nowait()
+    except queue.Empty:
+      try:
+        connection = self._connect()
+      except Exception:
+        self._slots.release()
+        raise
+    self._track(connection)
+    return connection
+
+  def _release(self, connection, broken=False):
+    self._untrack(connection)
+    if broken or self._closed:
+      self._close(connection)
+    else:
+      self._idle.put(connection)
+    self._slots.release()
+
+  def _track(self, connection):
+    with self._lock:
+      self._busy.add(connection)
+
+  def _untrack(self, connection):
+    with self._lock:
+      self._busy.discard(connection)
+
+  def _connect(self):
+    if self._closed:
+      raise smtplib.SMTPServerDisconnected('SMTP transport closed')
+    connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+    if self.starttls:
+      connection.starttls()
+    if self.username:
+      connection.login(self.username, self.password)
+    return connection
+
+  def _close(self, connection):
+    try:
+      connection.quit()
+    except (smtplib.SMTPException, OSError):
+      connection.close()
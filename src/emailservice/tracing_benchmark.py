@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the cost tracing adds to a SendOrderConfirmation call with each
+# sampling setting, against an in-process EmailService that accepts every
+# email. Spans are handed to an exporter that only counts them, so the
+# numbers cover creating, sampling and batching spans but not sending them.
+# TRACE_QUEUE_SIZE, TRACE_BATCH_SIZE and TRACE_EXPORT_DELAY_MS apply as in
+# the server:
+#
+#   python tracing_benchmark.py [calls] [rounds]
+
+import sys
+import time
+from concurrent import futures
+
+import grpc
+from opentelemetry.instrumentation.grpc import server_interceptor
+from opentelemetry.sdk.trace import TracerProvider, sampling
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+import demo_pb2
+import demo_pb2_grpc
+from tracing import RateLimitingSampler, newSpanProcessor
+
+SETTINGS = [
+  ('tracing off', None),
+  ('always on', sampling.ALWAYS_ON),
+  ('ratio 0.1', sampling.TraceIdRatioBased(0.1)),
+  ('ratio 0.01', sampling.TraceIdRatioBased(0.01)),
+  ('rate limited 10/s', RateLimitingSampler(10)),
+]
+
+class AcceptingEmailService(demo_pb2_grpc.EmailServiceServicer):
+  def SendOrderConfirmation(self, request, context):
+    return demo_pb2.Empty()
+
+class CountingExporter(SpanExporter):
+  def __init__(self):
+    self.spans = 0
+
+  def export(self, spans):
+    self.spans += len(spans)
+    return SpanExportResult.SUCCESS
+
+  def shutdown(self):
+    pass
+
+def run(sampler, order, calls):
+  exporter = CountingExporter()
+  interceptors = []
+  if sampler is not None:
+    provider = TracerProvider(sampler=sampling.ParentBased(sampler), shutdown_on_exit=False)
+    provider.add_span_processor(newSpanProcessor(exporter))
+    interceptors.append(server_interceptor(tracer_provider=provider))
+
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), interceptors=interceptors)
+  demo_pb2_grpc.add_EmailServiceServicer_to_server(AcceptingEmailService(), server)
+  port = server.add_insecure_port('127.0.0.1:0')
+  server.start()
+
+  channel = grpc.insecure_channel('127.0.0.1:{}'.format(port))
+  stub = demo_pb2_grpc.EmailServiceStub(channel)
+  request = demo_pb2.SendOrderConfirmationRequest(email = 'someone@example.com', order = order)
+  for _ in range(200):
+    stub.SendOrderConfirmation(request)
+  start = time.perf_counter()
+  for _ in range(calls):
+    stub.SendOrderConfirmation(request)
+  elapsed = time.perf_counter() - start
+
+  if sampler is not None:
+    provider.force_flush()
+  channel.close()
+  server.stop(0)
+  return elapsed / calls, exporter.spans
+
+if __name__ == '__main__':
+  calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  order = demo_pb2.OrderResult(order_id='6f1d3c2e', items=[
+    demo_pb2.OrderItem(item=demo_pb2.CartItem(product_id='OLJCESPC7Z', quantity=1))])
+  # the settings are measured in turns and the best round of each is kept,
+  # which takes out most of the noise of other load on the machine
+  best = {}
+  for _ in range(rounds):
+    for name, sampler in SETTINGS:
+      result = run(sampler, order, calls)
+      if name not in best or result[0] < best[name][0]:
+        best[name] = result
+  baseline = best['tracing off'][0]
+  for name, _ in SETTINGS:
+    per_call, spans = best[name]
+    print("{:<18} {:7.1f} us/call ({:+6.1f} us)  {} spans exported".format(
+      name, per_call * 1e6, (per_call - baseline) * 1e6, spans))
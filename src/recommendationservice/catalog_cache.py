@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import threading
+import time
+
+from metrics import REGISTRY
+from product_index import ProductIndex
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-catalog')
+
+CATALOG_FETCH_SECONDS = REGISTRY.histogram(
+    'recommendationservice_catalog_fetch_seconds',
+    'Time spent fetching the product catalog.')
+CATALOG_FETCH_ERRORS = REGISTRY.counter(
+    'recommendationservice_catalog_fetch_errors_total',
+    'Failed product catalog fetches.')
+
+# Immutable view of the product catalog. A new snapshot is swapped in on
+# every successful refresh, so readers never need to take a lock.
+CatalogSnapshot = collections.namedtuple(
+    'CatalogSnapshot', ['index', 'version', 'fetched_at'])
+
+
+# In-process cache of the product catalog. `fetch` is called to load the
+# list of product ids. Snapshots older than `ttl` seconds are still served
+# while a refresh runs in the background (stale-while-revalidate); once
+# started, a background thread also refreshes every `refresh_interval` seconds.
+# When a refresh fails the last good snapshot keeps being served, and requests
+# do not trigger another refresh for `retry_delay` seconds.
+class CatalogCache(object):
+
+    def __init__(self, fetch, ttl=60, refresh_interval=30, retry_delay=5):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._refresh_interval = refresh_interval
+        self._retry_delay = retry_delay
+        self._retry_at = 0.0
+        self._snapshot = None
+        self._version = 0
+        self._load_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self._load()
+        if self._stale(snapshot):
+            self._refresh_async()
+        return snapshot
+
+    def refresh(self):
+        start = time.perf_counter()
+        try:
+            product_ids = self._fetch()
+        except Exception:
+            CATALOG_FETCH_ERRORS.inc()
+            raise
+        finally:
+            CATALOG_FETCH_SECONDS.observe(time.perf_counter() - start)
+        return self._swap(product_ids)
+
+    def seed(self, product_ids):
+        # install an initial snapshot, e.g. one handed over by a parent process
+        return self._swap(product_ids)
+
+    def _swap(self, product_ids):
+        index = ProductIndex(product_ids)
+        with self._refresh_lock:
+            self._version += 1
+            self._snapshot = CatalogSnapshot(
+                index, self._version, time.monotonic())
+        return self._snapshot
+
+    def start(self):
+        try:
+            self._load()
+        except Exception as exc:
+            logger.warning("Initial catalog load failed: " + str(exc))
+        if self._refresh_interval > 0:
+            self._thread = threading.Thread(
+                target=self._run, name='catalog-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _load(self):
+        # only the first caller fetches, concurrent callers wait for it
+        with self._load_lock:
+            if self._snapshot is None:
+                self.refresh()
+                logger.info("Loaded {} products into catalog cache".format(
+                    len(self._snapshot.index)))
+            return self._snapshot
+
+    def _stale(self, snapshot):
+        now = time.monotonic()
+        return now - snapshot.fetched_at > self._ttl and now >= self._retry_at
+
+    def _begin_refresh(self):
+        # single-flight: at most one refresh is in progress at any time
+        with self._refresh_lock:
+            if self._refreshing:
+                return False
+            self._refreshing = True
+            return True
+
+    def _refresh_async(self):
+        if self._begin_refresh():
+            threading.Thread(target=self._refresh_once, daemon=True).start()
+
+    def _refresh_once(self):
+        try:
+            self.refresh()
+        except Exception as exc:
+            self._retry_at = time.monotonic() + self._retry_delay
+            logger.warning("Catalog refresh failed, serving stale snapshot: " + str(exc))
+        finally:
+            with self._refresh_lock:
+                self._refreshing = False
+
+    def _run(self):
+        while not self._stopped.wait(self._refresh_interval):
+            if self._begin_refresh():
+                self._refresh_once()
+
+
+# Variant of CatalogCache for the grpc.aio server: `fetch` is a coroutine
+# function and loads/refreshes run as tasks on the event loop instead of
+# threads, so the hot path never blocks the loop.
+class AsyncCatalogCache(CatalogCache):
+    def __init__(self, fetch, ttl=60, refresh_interval=30, retry_delay=5):
+        super(AsyncCatalogCache, self).__init__(fetch, ttl, refresh_interval, retry_delay)
+        self._async_load_lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def get_async(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return await self._load_async()
+        if self._stale(snapshot):
+            if self._begin_refresh():
+                self._spawn(self._refresh_once_async())
+        return snapshot
+
+    async def refresh_async(self):
+        start = time.perf_counter()
+        try:
+            product_ids = await self._fetch()
+        except Exception:
+            CATALOG_FETCH_ERRORS.inc()
+            raise
+        finally:
+            CATALOG_FETCH_SECONDS.observe(time.perf_counter() - start)
+        return self._swap(product_ids)
+
+    async def start_async(self):
+        try:
+            await self._load_async()
+        except Exception as exc:
+            logger.warning("Initial catalog load failed: " + str(exc))
+        if self._refresh_interval > 0:
+            self._spawn(self._run_async())
+
+    def stop(self):
+        super(AsyncCatalogCache, self).stop()
+        for task in self._tasks:
+            task.cancel()
+
+    def _spawn(self, coro):
+        # keep a reference so pending tasks are not garbage collected
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_async(self):
+        async with self._async_load_lock:
+            if self._snapshot is None:
+                await self.refresh_async()
+                logger.info("Loaded {} products into catalog cache".format(
+                    len(self._snapshot.index)))
+            return self._snapshot
+
+    async def _refresh_once_async(self):
+        try:
+            await self.refresh_async()
+        except Exception as exc:
+            self._retry_at = time.monotonic() + self._retry_delay
+            logger.warning("Catalog refresh failed, serving stale snapshot: " + str(exc))
+        finally:
+            with self._refresh_lock:
+                self._refreshing = False
+
+    async def _run_async(self):
+        while not self._stopped.is_set():
+            await asyncio.sleep(self._refresh_interval)
+            if self._begin_refresh():
+                await self._refresh_once_async()
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import itertools
+import os
+import queue
+import threading
+import time
+
+import grpc
+
+import demo_pb2
+import demo_pb2_grpc
+from metrics import REGISTRY
+
+HEDGED_CALLS = REGISTRY.counter(
+    'recommendationservice_catalog_hedged_calls_total',
+    'Catalog calls for which a hedged second call was sent.')
+REJECTED_CALLS = REGISTRY.counter(
+    'recommendationservice_catalog_rejected_calls_total',
+    'Catalog calls failed fast because the circuit breaker was open.')
+
+
+def channel_options():
+    # Each channel balances its calls over all addresses the catalog name
+    # resolves to (a headless Service gives one per pod). The local subchannel
+    # pool keeps gRPC from sharing one connection between channels that have
+    # the same target and arguments. Keepalive pings are only sent while
+    # calls are in flight and no more often than every 5 minutes: that is all
+    # productcatalogservice (a default grpc.NewServer()) accepts, it answers
+    # anything more with GOAWAY "too_many_pings" and drops the connection.
+    lb_policy = os.environ.get('CATALOG_LB_POLICY', "round_robin")
+    keepalive_ms = int(os.environ.get('CATALOG_KEEPALIVE_MS', "300000"))
+    options = [
+        ('grpc.lb_policy_name', lb_policy),
+        ('grpc.use_local_subchannel_pool', 1),
+    ]
+    if keepalive_ms > 0:
+        options += [
+            ('grpc.keepalive_time_ms', keepalive_ms),
+            ('grpc.keepalive_timeout_ms', int(os.environ.get('CATALOG_KEEPALIVE_TIMEOUT_MS', "10000"))),
+        ]
+    return options
+
+
+# Fixed set of channels to productcatalogservice, handed out round-robin so
+# concurrent calls are spread over several HTTP/2 connections instead of
+# queueing on the stream limit of a single one.
+class CatalogChannelPool(object):
+    def __init__(self, target, size, aio=False):
+        new_channel = grpc.aio.insecure_channel if aio else grpc.insecure_channel
+        self.channels = [new_channel(target, options=channel_options())
+                         for i in range(max(1, size))]
+        self._stubs = [demo_pb2_grpc.ProductCatalogServiceStub(c) for c in self.channels]
+        self._next = itertools.count()
+
+    def stub(self):
+        # itertools.count is safe to advance from several threads
+        return self._stubs[next(self._next) % len(self._stubs)]
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+    async def close_async(self):
+        for channel in self.channels:
+            await channel.close()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Opens after `failure_threshold` consecutive failed calls. While open, calls
+# are rejected without touching the network; after `reset_timeout` seconds a
+# single trial call is let through, and its outcome closes or re-opens the
+# circuit.
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+# Latencies of the last `size` successful calls, used to pick the hedging
+# delay. No percentile is reported until `min_samples` calls were seen.
+class LatencyWindow(object):
+    def __init__(self, size=100, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+# Calls ListProducts with a deadline, behind a circuit breaker. With
+# `hedge_percentile` set, a call that has not completed within that percentile
+# of recent latencies is raced against a second call on another channel of
+# the pool, and whichever succeeds first is used.
+class CatalogClient(object):
+    def __init__(self, pool, deadline, breaker=None, hedge_percentile=0):
+        self.pool = pool
+        self.deadline = deadline
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.latencies = LatencyWindow()
+
+    def list_product_ids(self):
+        self._check_circuit()
+        start = time.monotonic()
+        try:
+            cat_response = self._call()
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True, time.monotonic() - start)
+        return [x.id for x in cat_response.products]
+
+    def _check_circuit(self):
+        if self.breaker is not None and not self.breaker.allow():
+            REJECTED_CALLS.inc()
+            raise CircuitOpenError('product catalog circuit breaker is open')
+
+    def _record(self, ok, seconds=None):
+        if ok:
+            self.latencies.add(seconds)
+        if self.breaker is not None:
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _hedge_delay(self):
+        if self.hedge_percentile <= 0:
+            return None
+        delay = self.latencies.percentile(self.hedge_percentile)
+        if delay is None or delay >= self.deadline:
+            return None
+        return delay
+
+    def _call(self):
+        request = demo_pb2.Empty()
+        delay = self._hedge_delay()
+        first = self.pool.stub().ListProducts.future(request, timeout=self.deadline)
+        if delay is None:
+            return first.result()
+        done = queue.Queue()
+        first.add_done_callback(done.put)
+        calls = [first]
+        try:
+            call = done.get(timeout=delay)
+        except queue.Empty:
+            HEDGED_CALLS.inc()
+            hedge = self.pool.stub().ListProducts.future(request, timeout=self.deadline - delay)
+            hedge.add_done_callback(done.put)
+            calls.append(hedge)
+            call = done.get()
+            if call.exception() is not None:
+                # the first call to finish failed, the other one may still succeed
+                call = done.get()
+        for other in calls:
+            if other is not call:
+                other.cancel()
+        return call.result()
+
+
+class AsyncCatalogClient(CatalogClient):
+    async def list_product_ids(self):
+        self._check_circuit()
+        start = time.monotonic()
+        try:
+            cat_response = await self._call()
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True, time.monotonic() - start)
+        return [x.id for x in cat_response.products]
+
+    async def _call(self):
+        request = demo_pb2.Empty()
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self.pool.stub().ListProducts(request, timeout=self.deadline)
+        calls = {asyncio.ensure_future(self.pool.stub().ListProducts(request, timeout=self.deadline))}
+        done, pending = await asyncio.wait(calls, timeout=delay)
+        if not done:
+            HEDGED_CALLS.inc()
+            pending.add(asyncio.ensure_future(
+                self.pool.stub().ListProducts(request, timeout=self.deadline - delay)))
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending and all(call.exception() is not None for call in done):
+                # the first call to finish failed, the other one may still succeed
+                done, pending = await asyncio.wait(pending)
+        for call in pending:
+            call.cancel()
+        call = next((c for c in done if c.exception() is None), next(iter(done)))
+        return call.result()
+
+
+def new_catalog_client(target, aio=False):
+    # CATALOG_CHANNELS is the number of connections kept open per process and
+    # CATALOG_DEADLINE the timeout in seconds of every catalog call
+    pool = CatalogChannelPool(target, int(os.environ.get('CATALOG_CHANNELS', "4")), aio)
+    deadline = float(os.environ.get('CATALOG_DEADLINE', "5"))
+    # CATALOG_BREAKER_FAILURES consecutive failures open the circuit for
+    # CATALOG_BREAKER_RESET seconds, 0 disables the breaker
+    breaker = None
+    failures = int(os.environ.get('CATALOG_BREAKER_FAILURES', "5"))
+    if failures > 0:
+        breaker = CircuitBreaker(failures, float(os.environ.get('CATALOG_BREAKER_RESET', "30")))
+        REGISTRY.callback(
+            'recommendationservice_catalog_circuit_open',
+            'Whether the product catalog circuit breaker rejects calls.',
+            lambda: 0 if breaker.state == CircuitBreaker.CLOSED else 1)
+    # CATALOG_HEDGE_PERCENTILE (e.g. 95) enables hedged calls, 0 disables them
+    hedge_percentile = float(os.environ.get('CATALOG_HEDGE_PERCENTILE', "0"))
+    client_class = AsyncCatalogClient if aio else CatalogClient
+    return client_class(pool, deadline, breaker, hedge_percentile)
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import inspect
+import math
+import threading
+import time
+import weakref
+from concurrent import futures
+
+import grpc
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-concurrency')
+
+HEALTH_SERVICE = '/grpc.health.v1.Health/'
+
+
+# Adaptive limit on the number of calls in flight, after the gradient
+# limiter of Netflix's concurrency-limits. The latency of a call without
+# queueing is estimated as the lowest latency seen over the last `window`
+# calls; every completed call scales the limit by the ratio between that
+# baseline and a short moving average of latency (between 0.5 and 1 once
+# recent latency exceeds `tolerance` times the baseline) and adds a queue
+# allowance of sqrt(limit), so the limit grows while calls do not wait and
+# shrinks as soon as they start queueing. Calls that arrive while `limit`
+# calls are in flight are rejected.
+class AdaptiveLimiter(object):
+    def __init__(self, initial_limit=20, min_limit=2, max_limit=200,
+                 tolerance=2.0, smoothing=0.2, short_window=10, window=500):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self._short_alpha = 2.0 / (short_window + 1)
+        self._limit = float(initial_limit)
+        self._short = None
+        # lowest latency of the previous and of the current window
+        self._baseline = None
+        self._window_min = None
+        self._samples = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # returns a permit to release when the call completes, or None if the
+        # call is over the limit
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                self._rejected += 1
+                return None
+            self._in_flight += 1
+        return _Permit(self)
+
+    def _release(self, latency):
+        with self._lock:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            if latency is not None:
+                self._update(latency, in_flight)
+
+    def _update(self, latency, in_flight):
+        if self._short is None:
+            self._short = self._baseline = self._window_min = latency
+            return
+        self._short += (latency - self._short) * self._short_alpha
+        self._window_min = min(self._window_min, latency)
+        self._samples += 1
+        if self._samples >= self.window:
+            # forget old minimums so the baseline follows a service that got
+            # slower for good
+            self._baseline = self._window_min
+            self._window_min = latency
+            self._samples = 0
+        baseline = min(self._baseline, self._window_min)
+        gradient = max(0.5, min(1.0, self.tolerance * baseline / self._short))
+        target = self._limit * gradient + math.sqrt(self._limit)
+        limit = self._limit * (1 - self.smoothing) + target * self.smoothing
+        # the limit only grows while it is actually being used
+        if limit > self._limit and in_flight < self._limit / 2:
+            return
+        self._limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def stats(self):
+        with self._lock:
+            return {'limit': int(self._limit), 'in_flight': self._in_flight,
+                    'rejected': self._rejected}
+
+
+class _Permit(object):
+    __slots__ = ('_limiter', '_start', '_released')
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._start = time.perf_counter()
+        self._released = False
+
+    def release(self, completed=True):
+        # only the first release counts; calls that never ran (cancelled
+        # while queued) do not update the latency averages
+        if self._released:
+            return
+        self._released = True
+        self._limiter._release(time.perf_counter() - self._start if completed else None)
+
+
+def _limited(behavior, permit, streaming):
+    if streaming:
+        def wrapper(request, context):
+            try:
+                yield from behavior(request, context)
+            finally:
+                permit.release()
+    else:
+        def wrapper(request, context):
+            try:
+                return behavior(request, context)
+            finally:
+                permit.release()
+    # gRPC drops the call without running the behavior when the client
+    # cancels it while it waits for a worker thread, the permit is then
+    # released once the wrapper is garbage collected
+    weakref.finalize(wrapper, permit.release, False)
+    return wrapper
+
+
+def _limited_async(behavior, permit):
+    if inspect.isasyncgenfunction(behavior):
+        async def wrapper(request, context):
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            finally:
+                permit.release()
+    else:
+        async def wrapper(request, context):
+            try:
+                return await behavior(request, context)
+            finally:
+                permit.release()
+    weakref.finalize(wrapper, permit.release, False)
+    return wrapper
+
+
+def _replace_behavior(handler, wrap):
+    for name in ('unary_unary', 'unary_stream', 'stream_unary', 'stream_stream'):
+        behavior = getattr(handler, name)
+        if behavior is not None:
+            return handler._replace(**{name: wrap(behavior)})
+    return handler
+
+
+def _log_rejected(method, limiter):
+    logger.info("rejected {}, concurrency limit {} reached".format(
+        method, limiter.stats()['limit']))
+
+
+# Puts an AdaptiveLimiter in front of the servicers of a grpc.server. The
+# permit is taken when the call arrives, before it waits for a worker
+# thread, and calls over the limit fail with RESOURCE_EXHAUSTED from a
+# separate thread so that they never queue behind admitted calls (the
+# tracing interceptor wraps the behavior again, with tracing enabled they go
+# through the server's pool). Health checks are not limited.
+class ConcurrencyLimitInterceptor(grpc.ServerInterceptor):
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+        def reject(request, context):
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'concurrency limit reached')
+        reject.experimental_thread_pool = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='grpc-reject')
+        self._reject = reject
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None or handler_call_details.method.startswith(HEALTH_SERVICE):
+            return handler
+        permit = self.limiter.acquire()
+        if permit is None:
+            _log_rejected(handler_call_details.method, self.limiter)
+            return _replace_behavior(handler, lambda behavior: self._reject)
+        return _replace_behavior(
+            handler, lambda behavior: _limited(behavior, permit, handler.response_streaming))
+
+
+# Same as ConcurrencyLimitInterceptor for grpc.aio servers.
+class AsyncConcurrencyLimitInterceptor(grpc.aio.ServerInterceptor):
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None or handler_call_details.method.startswith(HEALTH_SERVICE):
+            return handler
+        permit = self.limiter.acquire()
+        if permit is None:
+            _log_rejected(handler_call_details.method, self.limiter)
+            return _replace_behavior(handler, lambda behavior: self._reject)
+        return _replace_behavior(handler, lambda behavior: _limited_async(behavior, permit))
+
+    async def _reject(self, request, context):
+        await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, 'concurrency limit reached')
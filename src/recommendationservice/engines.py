@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import os
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-engine')
+
+# A recommendation engine picks up to `k` product ids from the catalog `index`
+# (a ProductIndex) for a request that already contains `product_ids`:
+#
+#   engine.recommend(index, product_ids, k) -> list of product ids
+#
+# Engines must not return products from `product_ids`, and must only return
+# products that are present in `index`.
+
+
+class RandomEngine(object):
+    def recommend(self, index, product_ids, k):
+        return index.sample(k, exclude=product_ids)
+
+
+# Item-item co-occurrence model. Co-occurrence counts are kept as a sparse
+# matrix in CSR form (indptr/indices/data arrays) and the `top_n` strongest
+# neighbors of every product are precomputed when the model is loaded, so
+# answering a request only merges a few short neighbor lists. Slots that
+# cannot be filled from the model are filled by the fallback engine. NumPy is
+# only imported when a model is built or loaded.
+class CooccurrenceEngine(object):
+    def __init__(self, product_ids, indptr, indices, data, top_n=20,
+                 fallback=None):
+        import numpy as np
+        self.product_ids = list(product_ids)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=np.float32)
+        self.fallback = fallback or RandomEngine()
+        self._positions = {p: i for i, p in enumerate(self.product_ids)}
+        self._neighbors = self._top_neighbors(top_n)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        import numpy as np
+        with np.load(path, allow_pickle=False) as model:
+            return cls(model['product_ids'].tolist(), model['indptr'],
+                       model['indices'], model['data'], **kwargs)
+
+    @classmethod
+    def from_baskets(cls, baskets, **kwargs):
+        # builds the model from baskets (lists of product ids bought or viewed
+        # together), counting each unordered pair once per basket
+        import numpy as np
+        positions = {}
+        pairs = {}
+        for basket in baskets:
+            items = sorted({positions.setdefault(p, len(positions)) for p in basket})
+            for a, b in itertools.combinations(items, 2):
+                pairs[(a, b)] = pairs.get((a, b), 0) + 1
+        n = len(positions)
+        rows = [[] for _ in range(n)]
+        for (a, b), count in pairs.items():
+            rows[a].append((b, count))
+            rows[b].append((a, count))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indices = []
+        data = []
+        for i, row in enumerate(rows):
+            row.sort()
+            indices.extend(j for j, _ in row)
+            data.extend(c for _, c in row)
+            indptr[i + 1] = len(indices)
+        product_ids = sorted(positions, key=positions.get)
+        return cls(product_ids, indptr, indices, data, **kwargs)
+
+    def save(self, path):
+        import numpy as np
+        np.savez_compressed(path, product_ids=np.array(self.product_ids),
+                            indptr=self.indptr, indices=self.indices,
+                            data=self.data)
+
+    def _top_neighbors(self, top_n):
+        import numpy as np
+        neighbors = []
+        for i in range(len(self.product_ids)):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            row_indices = self.indices[start:end]
+            row_data = self.data[start:end]
+            if end - start > top_n:
+                top = np.argpartition(-row_data, top_n)[:top_n]
+                row_indices = row_indices[top]
+                row_data = row_data[top]
+            order = np.argsort(-row_data, kind='stable')
+            neighbors.append(list(zip(
+                [self.product_ids[j] for j in row_indices[order].tolist()],
+                row_data[order].tolist())))
+        return neighbors
+
+    def recommend(self, index, product_ids, k):
+        excluded = set(product_ids)
+        scores = {}
+        for product_id in excluded:
+            pos = self._positions.get(product_id)
+            if pos is None:
+                continue
+            for neighbor, score in self._neighbors[pos]:
+                if neighbor not in excluded and neighbor in index:
+                    scores[neighbor] = scores.get(neighbor, 0.0) + score
+        result = sorted(scores, key=scores.get, reverse=True)[:k]
+        if len(result) < k:
+            excluded.update(result)
+            result.extend(self.fallback.recommend(index, excluded, k - len(result)))
+        return result
+
+
+def new_engine():
+    name = os.environ.get('RECOMMENDATION_ENGINE', "random")
+    if name == "cooccurrence":
+        path = os.environ.get('COOCCURRENCE_MODEL_PATH', '')
+        if path == "":
+            raise Exception('COOCCURRENCE_MODEL_PATH environment variable not set')
+        engine = CooccurrenceEngine.load(
+            path, top_n=int(os.environ.get('COOCCURRENCE_TOP_N', "20")))
+        logger.info("Loaded co-occurrence model for {} products from {}".format(
+            len(engine.product_ids), path))
+        return engine
+    if name != "random":
+        raise Exception('unknown RECOMMENDATION_ENGINE: ' + name)
+    return RandomEngine()
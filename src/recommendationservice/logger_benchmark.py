@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures how many records per second the JSON log formatters can format:
+#
+#   python logger_benchmark.py [records]
+
+import json
+import logging
+import sys
+import time
+
+from logger import CustomJsonFormatter, FastJsonFormatter
+
+
+def make_records(n):
+    records = []
+    for i in range(n):
+        record = logging.LogRecord(
+            'recommendationservice-server', logging.INFO, __file__, 1,
+            '[Recv ListRecommendations] product_ids=%s', (['OLJCESPC7Z', 'L9ECAV7KIM'],), None)
+        if i % 10 == 0:
+            record.suppressed = i
+        records.append(record)
+    return records
+
+
+def run(formatter, records):
+    start = time.perf_counter()
+    for record in records:
+        formatter.format(record)
+    return len(records) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    legacy = CustomJsonFormatter('%(timestamp)s %(severity)s %(name)s %(message)s')
+    fast = FastJsonFormatter()
+
+    # both formatters must produce the same document
+    for record in make_records(20):
+        assert json.loads(legacy.format(record)) == json.loads(fast.format(record))
+
+    before = run(legacy, make_records(n))
+    after = run(fast, make_records(n))
+    print("python-json-logger: {:.0f} records/s".format(before))
+    print("fast formatter:     {:.0f} records/s".format(after))
+    print("speedup:            {:.1f}x".format(after / before))
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-prefork')
+
+# gRPC does not support forking a process that already has channels open, so
+# workers are started with "spawn" and get their initial state (e.g. the
+# catalog snapshot) as picklable arguments.
+_mp = multiprocessing.get_context('spawn')
+
+
+# Runs `workers` copies of `target(slot, *args)` in child processes, `slot`
+# being the worker number in [0, workers), and restarts any that exit while
+# the supervisor is running. Repeated crashes of the same worker are
+# restarted with exponential backoff.
+class Supervisor(object):
+    def __init__(self, target, args, workers, restart_delay=1.0,
+                 max_restart_delay=30.0, stable_after=60.0):
+        self._target = target
+        self._args = args
+        self._workers = workers
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._stable_after = stable_after
+        self._procs = [None] * workers
+        self._started_at = [0.0] * workers
+        self._delays = [restart_delay] * workers
+        self._restart_at = [0.0] * workers
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for slot in range(self._workers):
+            self._start(slot)
+        while not self._stopping:
+            self._reap()
+            sentinels = [p.sentinel for p in self._procs if p is not None]
+            multiprocessing.connection.wait(sentinels, timeout=1.0)
+        self._shutdown()
+
+    def _start(self, slot):
+        proc = _mp.Process(target=self._target, args=(slot,) + tuple(self._args),
+                           name='worker-{}'.format(slot), daemon=True)
+        proc.start()
+        self._procs[slot] = proc
+        self._started_at[slot] = time.monotonic()
+        logger.info("started worker {} (pid {})".format(slot, proc.pid))
+
+    def _reap(self):
+        now = time.monotonic()
+        for slot, proc in enumerate(self._procs):
+            if proc is not None and not proc.is_alive():
+                logger.warning("worker {} (pid {}) exited with code {}".format(
+                    slot, proc.pid, proc.exitcode))
+                if now - self._started_at[slot] > self._stable_after:
+                    self._delays[slot] = self._restart_delay
+                self._restart_at[slot] = now + self._delays[slot]
+                self._delays[slot] = min(self._delays[slot] * 2, self._max_restart_delay)
+                self._procs[slot] = None
+            if self._procs[slot] is None and now >= self._restart_at[slot]:
+                self._start(slot)
+
+    def _on_signal(self, signum, frame):
+        self._stopping = True
+
+    def _shutdown(self):
+        logger.info("stopping {} workers".format(self._workers))
+        procs = [p for p in self._procs if p is not None]
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+
+# Array-backed index of product ids. Ids are stored once in a list, with a
+# map from id to its position kept alongside, so that sampling never has to
+# copy or filter the whole catalog.
+class ProductIndex(object):
+    def __init__(self, product_ids=()):
+        self._ids = []
+        self._positions = {}
+        for product_id in product_ids:
+            if product_id not in self._positions:
+                self._positions[product_id] = len(self._ids)
+                self._ids.append(product_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, product_id):
+        return product_id in self._positions
+
+    def sample(self, k, exclude=(), rng=random):
+        # Partial Fisher-Yates shuffle over a virtual copy of the id array.
+        # Only swapped positions are materialized in `swapped`, so the cost is
+        # O(k + len(exclude)) regardless of the catalog size.
+        swapped = {}
+        moved = {}
+        end = len(self._ids)
+
+        # move excluded products past the end of the sampling range
+        for product_id in set(exclude):
+            pos = self._positions.get(product_id)
+            if pos is None:
+                continue
+            pos = moved.get(pos, pos)
+            end -= 1
+            last = swapped.get(end, end)
+            swapped[pos] = last
+            moved[last] = pos
+            swapped[end] = self._positions[product_id]
+
+        k = min(k, end)
+        result = []
+        for i in range(k):
+            j = rng.randrange(i, end)
+            picked = swapped.get(j, j)
+            swapped[j] = swapped.get(i, i)
+            swapped[i] = picked
+            result.append(self._ids[picked])
+        return result
@@ -14,14 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import functools
+import importlib
 import os
-import random
+import signal
+import threading
 import time
 import traceback
 from concurrent import futures
 
-import googlecloudprofiler
-from google.auth.exceptions import DefaultCredentialsError
+_startup_began = time.perf_counter()
+
 import grpc
 
 import demo_pb2
@@ -29,16 +33,39 @@ import demo_pb2_grpc
 from grpc_health.v1 import health_pb2
 from grpc_health.v1 import health_pb2_grpc
 
-from opentelemetry import trace
-from opentelemetry.instrumentation.grpc import GrpcInstrumentorClient, GrpcInstrumentorServer
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-
+import metrics
+from catalog_cache import AsyncCatalogCache, CatalogCache
+from catalog_client import new_catalog_client
+from concurrency_limit import AdaptiveLimiter, AsyncConcurrencyLimitInterceptor, ConcurrencyLimitInterceptor
+from engines import new_engine
+from response_cache import ResponseCache
+from prefork import Supervisor
 from logger import getJSONLogger
 logger = getJSONLogger('recommendationservice-server')
 
+# The profiler and OpenTelemetry packages take several hundred milliseconds
+# to import, so they are only imported (through timed_import) by the code
+# paths that use them. Import times are reported once the server is up.
+import_times = [('<module imports>', time.perf_counter() - _startup_began)]
+
+def timed_import(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times.append((name, time.perf_counter() - start))
+    return module
+
+def logStartupReport():
+    report = ", ".join("{}={:.3f}s".format(name, t) for name, t in import_times)
+    logger.info("started in {:.3f}s, import times: {}".format(
+        time.perf_counter() - _startup_began, report))
+
+# Bounded exponential backoff for starting the profiler agent.
+PROFILER_MAX_ATTEMPTS = 5
+PROFILER_INITIAL_DELAY = 1
+PROFILER_MAX_DELAY = 30
+
 def initStackdriverProfiling():
+  googlecloudprofiler = timed_import('googlecloudprofiler')
   project_id = None
   try:
     project_id = os.environ["GCP_PROJECT_ID"]
@@ -46,43 +73,102 @@ def initStackdriverProfiling():
     # Environment variable not set
     pass
 
-  for retry in range(1,4):
+  # This runs on the profiler-init thread, and the agent can only enable
+  # wall time profiling from the main thread, so it profiles CPU time only.
+  # Wall time of the main thread would mostly show serve() blocked in
+  # stopping.wait() anyway.
+  delay = PROFILER_INITIAL_DELAY
+  for attempt in range(1, PROFILER_MAX_ATTEMPTS + 1):
     try:
       if project_id:
-        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, project_id=project_id)
+        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, project_id=project_id, disable_wall_profiling=True)
       else:
-        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0)
+        googlecloudprofiler.start(service='recommendation_server', service_version='1.0.0', verbose=0, disable_wall_profiling=True)
       logger.info("Successfully started Stackdriver Profiler.")
       return
     except (BaseException) as exc:
       logger.info("Unable to start Stackdriver Profiler Python agent. " + str(exc))
-      if (retry < 4):
-        logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(retry*10))
-        time.sleep (1)
+      if (attempt < PROFILER_MAX_ATTEMPTS):
+        logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(delay))
+        time.sleep(delay)
+        delay = min(delay * 2, PROFILER_MAX_DELAY)
       else:
         logger.warning("Could not initialize Stackdriver Profiler after retrying, giving up")
   return
 
+def startStackdriverProfiling():
+  # the agent is started in the background so that an unreachable profiler
+  # backend does not hold up serving
+  threading.Thread(target=initStackdriverProfiling, name='profiler-init', daemon=True).start()
+
+SAMPLE_SECONDS = metrics.REGISTRY.histogram(
+    'recommendationservice_sample_seconds',
+    'Time spent by the engine picking products for one request.')
+
+def rpc_metrics(method):
+    return metrics.track(
+        metrics.REGISTRY.counter(
+            'recommendationservice_requests_total', 'RPCs received.', method=method),
+        metrics.REGISTRY.counter(
+            'recommendationservice_errors_total', 'RPCs that failed.', method=method),
+        metrics.REGISTRY.histogram(
+            'recommendationservice_rpc_duration_seconds', 'Time spent serving an RPC.', method=method))
+
 class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
+    def __init__(self, catalog, engine, cache=None):
+        self.catalog = catalog
+        self.engine = engine
+        self.cache = cache
+        # cleared when the server starts draining so that health checks
+        # report NOT_SERVING while in-flight calls finish
+        self.serving = True
+
+    @rpc_metrics('ListRecommendations')
     def ListRecommendations(self, request, context):
+        # read the catalog snapshot from the in-memory catalog cache
+        response = self.recommend(self.catalog.get(), request)
+        logger.info("[Recv ListRecommendations] product_ids=%s", response.product_ids)
+        return response
+
+    @rpc_metrics('ListRecommendationsBatch')
+    def ListRecommendationsBatch(self, request, context):
+        # the whole batch is answered from a single catalog snapshot
+        snapshot = self.catalog.get()
+        logger.info("[Recv ListRecommendationsBatch] requests=%d", len(request.requests))
+        response = demo_pb2.ListRecommendationsBatchResponse()
+        response.responses.extend(self.recommend(snapshot, r) for r in request.requests)
+        return response
+
+    @rpc_metrics('StreamRecommendations')
+    def StreamRecommendations(self, request, context):
+        snapshot = self.catalog.get()
+        logger.info("[Recv StreamRecommendations] requests=%d", len(request.requests))
+        for r in request.requests:
+            yield self.recommend(snapshot, r)
+
+    def recommend(self, snapshot, request):
+        # repeated requests for the same user and products are answered from
+        # the response cache until the catalog snapshot changes
+        if self.cache is not None:
+            key = ResponseCache.fingerprint(request)
+            response = self.cache.get(key, snapshot.version)
+            if response is not None:
+                return response
         max_responses = 5
-        # fetch list of products from product catalog stub
-        cat_response = product_catalog_stub.ListProducts(demo_pb2.Empty())
-        product_ids = [x.id for x in cat_response.products]
-        filtered_products = list(set(product_ids)-set(request.product_ids))
-        num_products = len(filtered_products)
-        num_return = min(max_responses, num_products)
-        # sample list of indicies to return
-        indices = random.sample(range(num_products), num_return)
-        # fetch product ids from indices
-        prod_list = [filtered_products[i] for i in indices]
-        logger.info("[Recv ListRecommendations] product_ids={}".format(prod_list))
+        # let the engine pick products, skipping the ones already in the request
+        with SAMPLE_SECONDS.time():
+            prod_list = self.engine.recommend(snapshot.index, request.product_ids, max_responses)
         # build and return response
         response = demo_pb2.ListRecommendationsResponse()
         response.product_ids.extend(prod_list)
+        if self.cache is not None:
+            self.cache.put(key, snapshot.version, response)
         return response
 
     def Check(self, request, context):
+        if not self.serving:
+            return health_pb2.HealthCheckResponse(
+                status=health_pb2.HealthCheckResponse.NOT_SERVING)
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.SERVING)
 
@@ -90,53 +176,196 @@ class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.UNIMPLEMENTED)
 
+# Servicer for the grpc.aio server: same logic as RecommendationService,
+# but the catalog is read without blocking the event loop.
+class AsyncRecommendationService(RecommendationService):
+    @rpc_metrics('ListRecommendations')
+    async def ListRecommendations(self, request, context):
+        snapshot = await self.catalog.get_async()
+        response = self.recommend(snapshot, request)
+        logger.info("[Recv ListRecommendations] product_ids=%s", response.product_ids)
+        return response
 
-if __name__ == "__main__":
-    logger.info("initializing recommendationservice")
+    @rpc_metrics('ListRecommendationsBatch')
+    async def ListRecommendationsBatch(self, request, context):
+        snapshot = await self.catalog.get_async()
+        logger.info("[Recv ListRecommendationsBatch] requests=%d", len(request.requests))
+        response = demo_pb2.ListRecommendationsBatchResponse()
+        response.responses.extend(self.recommend(snapshot, r) for r in request.requests)
+        return response
+
+    @rpc_metrics('StreamRecommendations')
+    async def StreamRecommendations(self, request, context):
+        snapshot = await self.catalog.get_async()
+        logger.info("[Recv StreamRecommendations] requests=%d", len(request.requests))
+        for r in request.requests:
+            yield self.recommend(snapshot, r)
 
+    async def Check(self, request, context):
+        return super(AsyncRecommendationService, self).Check(request, context)
+
+    async def Watch(self, request, context):
+        return super(AsyncRecommendationService, self).Watch(request, context)
+
+# the SDK tracer provider, set when tracing is enabled
+tracer_provider = None
+
+def initTracing(server_mode):
+    global tracer_provider
+    if os.environ.get("ENABLE_TRACING") != "1":
+        logger.info("Tracing disabled.")
+        return
+
+    auth_exceptions = timed_import('google.auth.exceptions')
+    try:
+      trace = timed_import('opentelemetry.trace')
+      grpc_instrumentation = timed_import('opentelemetry.instrumentation.grpc')
+      sdk_trace = timed_import('opentelemetry.sdk.trace')
+      tracing = timed_import('tracing')
+      trace_exporter = timed_import('opentelemetry.exporter.otlp.proto.grpc.trace_exporter')
+      if server_mode == "aio":
+        grpc_instrumentation.GrpcAioInstrumentorClient().instrument()
+        grpc_instrumentation.GrpcAioInstrumentorServer().instrument()
+      else:
+        grpc_client_instrumentor = grpc_instrumentation.GrpcInstrumentorClient()
+        grpc_client_instrumentor.instrument()
+        grpc_server_instrumentor = grpc_instrumentation.GrpcInstrumentorServer()
+        grpc_server_instrumentor.instrument()
+      # spans are flushed (with a deadline) when the server drains, instead
+      # of by the SDK's exit hook that retries an unreachable collector for
+      # about a minute
+      tracer_provider = sdk_trace.TracerProvider(
+          sampler=tracing.new_sampler(), shutdown_on_exit=False)
+      trace.set_tracer_provider(tracer_provider)
+      otel_endpoint = os.getenv("COLLECTOR_SERVICE_ADDR", "localhost:4317")
+      tracer_provider.add_span_processor(
+        tracing.new_span_processor(
+            trace_exporter.OTLPSpanExporter(
+            endpoint = otel_endpoint,
+            insecure = True
+          )
+        )
+      )
+    except auth_exceptions.DefaultCredentialsError:
+        logger.info("Tracing disabled.")
+    except Exception as e:
+        logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
+
+def initTelemetry(server_mode):
     try:
       if "DISABLE_PROFILER" in os.environ:
         raise KeyError()
       else:
         logger.info("Profiler enabled.")
-        initStackdriverProfiling()
+        startStackdriverProfiling()
     except KeyError:
         logger.info("Profiler disabled.")
 
-    try:
-      grpc_client_instrumentor = GrpcInstrumentorClient()
-      grpc_client_instrumentor.instrument()
-      grpc_server_instrumentor = GrpcInstrumentorServer()
-      grpc_server_instrumentor.instrument()
-      if os.environ["ENABLE_TRACING"] == "1":
-        trace.set_tracer_provider(TracerProvider())
-        otel_endpoint = os.getenv("COLLECTOR_SERVICE_ADDR", "localhost:4317")
-        trace.get_tracer_provider().add_span_processor(
-          BatchSpanProcessor(
-              OTLPSpanExporter(
-              endpoint = otel_endpoint,
-              insecure = True
-            )
-          )
-        )
-    except (KeyError, DefaultCredentialsError):
-        logger.info("Tracing disabled.")
-    except Exception as e:
-        logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
+    initTracing(server_mode)
 
-    port = os.environ.get('PORT', "8080")
-    catalog_addr = os.environ.get('PRODUCT_CATALOG_SERVICE_ADDR', '')
-    if catalog_addr == "":
-        raise Exception('PRODUCT_CATALOG_SERVICE_ADDR environment variable not set')
-    logger.info("product catalog address: " + catalog_addr)
-    channel = grpc.insecure_channel(catalog_addr)
-    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
+def server_options(reuse_port):
+    # SO_REUSEPORT lets several worker processes bind the same port and have
+    # the kernel spread incoming connections between them
+    return [('grpc.so_reuseport', 1 if reuse_port else 0)]
+
+def new_catalog_cache(cache_class, fetch, product_ids):
+    catalog = cache_class(
+        fetch,
+        ttl=float(os.environ.get('CATALOG_CACHE_TTL', "60")),
+        refresh_interval=float(os.environ.get('CATALOG_REFRESH_INTERVAL', "30")),
+        retry_delay=float(os.environ.get('CATALOG_RETRY_DELAY', "5")))
+    if product_ids is not None:
+        catalog.seed(product_ids)
+    return catalog
+
+def new_response_cache():
+    # RESPONSE_CACHE_MAX_BYTES=0 disables the response cache
+    max_bytes = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+    if max_bytes <= 0:
+        return None
+    cache = ResponseCache(max_bytes, float(os.environ.get('RESPONSE_CACHE_TTL', "10")))
+    for stat, kind in [('hits', 'counter'), ('misses', 'counter'),
+                       ('evictions', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')]:
+        metrics.REGISTRY.callback(
+            'recommendationservice_response_cache_' + stat + ('_total' if kind == 'counter' else ''),
+            'Response cache ' + stat + '.',
+            functools.partial(lambda stat: cache.stats()[stat], stat), kind=kind)
+    return cache
+
+def new_interceptors(interceptor_class):
+    # CONCURRENCY_LIMIT_MAX=0 disables admission control; otherwise calls are
+    # admitted up to an adaptive limit that starts at
+    # CONCURRENCY_LIMIT_INITIAL and stays within CONCURRENCY_LIMIT_MIN and
+    # CONCURRENCY_LIMIT_MAX
+    max_limit = int(os.environ.get('CONCURRENCY_LIMIT_MAX', "200"))
+    if max_limit <= 0:
+        return []
+    limiter = AdaptiveLimiter(
+        initial_limit=int(os.environ.get('CONCURRENCY_LIMIT_INITIAL', "20")),
+        min_limit=int(os.environ.get('CONCURRENCY_LIMIT_MIN', "2")),
+        max_limit=max_limit,
+        tolerance=float(os.environ.get('CONCURRENCY_LIMIT_TOLERANCE', "2")))
+    for stat, kind, documentation in [
+            ('limit', 'gauge', 'Current adaptive concurrency limit.'),
+            ('in_flight', 'gauge', 'Calls admitted and not completed yet.'),
+            ('rejected', 'counter', 'Calls rejected by the concurrency limit.')]:
+        metrics.REGISTRY.callback(
+            'recommendationservice_concurrency_' + stat + ('_total' if kind == 'counter' else ''),
+            documentation,
+            functools.partial(lambda stat: limiter.stats()[stat], stat), kind=kind)
+    return [interceptor_class(limiter)]
+
+def start_metrics_server(slot=0):
+    # METRICS_PORT enables the Prometheus endpoint; prefork workers listen on
+    # METRICS_PORT + worker number
+    port = int(os.environ.get('METRICS_PORT', "0"))
+    if port > 0:
+        metrics.start_http_server(port + slot)
+        logger.info("serving metrics on port: " + str(port + slot))
+
+def shutdown_timeouts():
+    # SHUTDOWN_DELAY is how long (in seconds) health checks report NOT_SERVING
+    # before the server stops accepting calls, to give load balancers time to
+    # take the instance out of rotation; SHUTDOWN_GRACE_PERIOD is how long
+    # in-flight calls, closing the catalog client and flushing traces then get
+    # together. Both count towards the pod's terminationGracePeriodSeconds (5s
+    # in the manifests), raise it along with them
+    return (float(os.environ.get('SHUTDOWN_DELAY', "0")),
+            float(os.environ.get('SHUTDOWN_GRACE_PERIOD', "4")))
+
+def begin_drain(service):
+    # returns the delay and the deadline by which every step of the drain has
+    # to be done, each step only gets the time that is left
+    delay, grace = shutdown_timeouts()
+    logger.info("draining: stopping in {}s, done within {}s".format(delay, delay + grace))
+    service.serving = False
+    return delay, time.monotonic() + delay + grace
+
+def time_left(deadline):
+    # seconds left until `deadline` (a time.monotonic() value)
+    return max(0.0, deadline - time.monotonic())
+
+def flush_traces(timeout):
+    # exports the spans still buffered by the batch span processor, giving up
+    # after `timeout` seconds if the collector is unreachable
+    if tracer_provider is not None:
+        tracer_provider.force_flush(int(timeout * 1000))
+
+def serve(port, catalog_addr, product_ids=None, reuse_port=False):
+    catalog_client = new_catalog_client(catalog_addr)
+
+    # keep an in-memory snapshot of the catalog, refreshed in the background
+    catalog = new_catalog_cache(
+        CatalogCache, catalog_client.list_product_ids, product_ids)
+    catalog.start()
 
     # create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                         interceptors=new_interceptors(ConcurrencyLimitInterceptor),
+                         options=server_options(reuse_port))
 
     # add class to gRPC server
-    service = RecommendationService()
+    service = RecommendationService(catalog, new_engine(), new_response_cache())
     demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
     health_pb2_grpc.add_HealthServicer_to_server(service, server)
 
@@ -144,10 +373,102 @@ if __name__ == "__main__":
     logger.info("listening on port: " + port)
     server.add_insecure_port('[::]:'+port)
     server.start()
+    logStartupReport()
+
+    # SIGTERM (rolling restarts, prefork supervisor) and SIGINT both drain
+    # the server
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopping.set())
+    stopping.wait()
+
+    delay, deadline = begin_drain(service)
+    time.sleep(delay)
+    server.stop(time_left(deadline)).wait()
+    catalog.stop()
+    catalog_client.pool.close()
+    flush_traces(time_left(deadline))
+
+async def serve_aio(port, catalog_addr, product_ids=None, reuse_port=False):
+    catalog_client = new_catalog_client(catalog_addr, aio=True)
+
+    catalog = new_catalog_cache(
+        AsyncCatalogCache, catalog_client.list_product_ids, product_ids)
+    await catalog.start_async()
+
+    # a single event loop serves all calls, no per-request worker threads
+    server = grpc.aio.server(
+        interceptors=new_interceptors(AsyncConcurrencyLimitInterceptor),
+        options=server_options(reuse_port))
+
+    service = AsyncRecommendationService(catalog, new_engine(), new_response_cache())
+    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
+    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+    logger.info("listening on port: " + port + " (asyncio)")
+    server.add_insecure_port('[::]:'+port)
+    await server.start()
+    logStartupReport()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
 
-    # keep alive
+    delay, deadline = begin_drain(service)
+    await asyncio.sleep(delay)
+    await server.stop(time_left(deadline))
+    catalog.stop()
+    await catalog_client.pool.close_async()
+    flush_traces(time_left(deadline))
+
+def run(server_mode, port, catalog_addr, product_ids=None, reuse_port=False):
+    if server_mode == "aio":
+        asyncio.run(serve_aio(port, catalog_addr, product_ids, reuse_port))
+    else:
+        serve(port, catalog_addr, product_ids, reuse_port)
+
+def run_worker(slot, server_mode, port, catalog_addr, product_ids):
+    # entry point of a prefork worker process
+    initTelemetry(server_mode)
+    start_metrics_server(slot)
+    run(server_mode, port, catalog_addr, product_ids, reuse_port=True)
+
+def load_catalog_snapshot(catalog_addr):
+    # fetched once by the supervisor so that all workers start from the same
+    # catalog without each hitting productcatalogservice at boot
+    catalog_client = new_catalog_client(catalog_addr)
     try:
-         while True:
-            time.sleep(10000)
-    except KeyboardInterrupt:
-            server.stop(0)
+        return catalog_client.list_product_ids()
+    except grpc.RpcError as err:
+        logger.warning("Could not load catalog snapshot, workers will fetch it: " + str(err))
+        return None
+    finally:
+        catalog_client.pool.close()
+
+
+if __name__ == "__main__":
+    logger.info("initializing recommendationservice")
+
+    # "aio" selects the asyncio server, anything else the thread pool server
+    server_mode = os.environ.get('SERVER_MODE', "sync")
+    # number of server processes, each bound to PORT with SO_REUSEPORT
+    workers = int(os.environ.get('WORKERS', "1"))
+
+    port = os.environ.get('PORT', "8080")
+    catalog_addr = os.environ.get('PRODUCT_CATALOG_SERVICE_ADDR', '')
+    if catalog_addr == "":
+        raise Exception('PRODUCT_CATALOG_SERVICE_ADDR environment variable not set')
+    logger.info("product catalog address: " + catalog_addr)
+
+    if workers > 1:
+        logger.info("starting {} worker processes".format(workers))
+        product_ids = load_catalog_snapshot(catalog_addr)
+        Supervisor(run_worker,
+                   (server_mode, port, catalog_addr, product_ids),
+                   workers).run()
+    else:
+        initTelemetry(server_mode)
+        start_metrics_server()
+        run(server_mode, port, catalog_addr)
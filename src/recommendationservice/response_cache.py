@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import sys
+import threading
+import time
+
+# rough per-entry bookkeeping cost (dict slot, tuple, key tuple) in bytes
+_ENTRY_OVERHEAD = 200
+
+
+# Bounded LRU cache of ListRecommendations responses with a TTL. Entries are
+# keyed on a normalized request fingerprint and tagged with the catalog
+# snapshot version they were computed from; the cache empties itself as soon
+# as it sees a newer version. Cached responses are shared between callers
+# and must not be mutated.
+class ResponseCache(object):
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(request):
+        return (request.user_id, tuple(sorted(set(request.product_ids))))
+
+    def get(self, key, version):
+        now = time.monotonic()
+        with self._lock:
+            if not self._check_version(version):
+                self.misses += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, response):
+        size = (response.ByteSize() + sys.getsizeof(key[0]) +
+                sum(sys.getsizeof(p) for p in key[1]) + _ENTRY_OVERHEAD)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if not self._check_version(version):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, response, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def _check_version(self, version):
+        # a newer catalog snapshot invalidates everything cached so far, and
+        # callers still holding an older snapshot bypass the cache
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+        return version == self._version
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+import time
+
+from opentelemetry.sdk.trace import sampling
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+
+# Samples at most `rate` traces per second (a token bucket allowing bursts
+# of one second worth of traces, or of one trace below one per second).
+class RateLimitingSampler(sampling.Sampler):
+    def __init__(self, rate):
+        self.rate = rate
+        self._burst = max(rate, 1.0)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def should_sample(self, parent_context, trace_id, name, kind=None,
+                      attributes=None, links=None, trace_state=None):
+        now = time.monotonic()
+        with self._lock:
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            sampled = self._tokens >= 1
+            if sampled:
+                self._tokens -= 1
+        if sampled:
+            return sampling.SamplingResult(sampling.Decision.RECORD_AND_SAMPLE, attributes)
+        return sampling.SamplingResult(sampling.Decision.DROP)
+
+    def get_description(self):
+        return 'RateLimitingSampler{{{}}}'.format(self.rate)
+
+
+def new_sampler():
+    # TRACE_SAMPLER picks how new traces are sampled: "always_on", "ratio"
+    # (TRACE_SAMPLE_RATIO of them) or "rate_limited" (at most
+    # TRACE_SAMPLE_RATE per second). Calls that are part of a trace started
+    # by a caller keep the caller's decision. When unset the SDK's own
+    # OTEL_TRACES_SAMPLER setting applies (parent based always on by default).
+    name = os.environ.get('TRACE_SAMPLER', '')
+    if name == "":
+        return None
+    if name == "always_on":
+        root = sampling.ALWAYS_ON
+    elif name == "ratio":
+        root = sampling.TraceIdRatioBased(float(os.environ.get('TRACE_SAMPLE_RATIO', "0.1")))
+    elif name == "rate_limited":
+        root = RateLimitingSampler(float(os.environ.get('TRACE_SAMPLE_RATE', "10")))
+    else:
+        raise Exception('unknown TRACE_SAMPLER: ' + name)
+    return sampling.ParentBased(root)
+
+
+def new_span_processor(exporter):
+    # TRACE_QUEUE_SIZE bounds the number of spans waiting to be exported
+    # (spans are dropped when it is full), TRACE_BATCH_SIZE is the number of
+    # spans per export and TRACE_EXPORT_DELAY_MS the time between exports.
+    # Unset values fall back to the SDK's OTEL_BSP_* settings.
+    def setting(name):
+        value = os.environ.get(name, '')
+        return int(value) if value else None
+    return BatchSpanProcessor(
+        exporter,
+        max_queue_size=setting('TRACE_QUEUE_SIZE'),
+        max_export_batch_size=setting('TRACE_BATCH_SIZE'),
+        schedule_delay_millis=setting('TRACE_EXPORT_DELAY_MS'))